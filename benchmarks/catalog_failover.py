@@ -0,0 +1,131 @@
+"""Group edits reach a standby dispatcher that takes over.
+
+Starts two dispatcher processes on a scratch database. The standby resolves
+a group (as its schedule engine does) so that group sits in its membership
+index and plan cache. Another process then adds an intercom to the group,
+the leader drains, and once the standby holds the lease the script checks
+that it resolves the new membership. Exits non-zero if it doesn't.
+
+    python benchmarks/catalog_failover.py
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("INTERCOM_NOTIFY_HOST", "127.0.0.1")
+
+TAKEOVER_TIMEOUT = 30
+
+
+def run_node(database_uri):
+    # A dispatcher that answers "state <group id> <sound id>" and "drain" on stdin
+    os.environ["INTERCOM_DATABASE_URI"] = database_uri
+    os.environ["INTERCOM_DISPATCHER"] = "1"
+    import server
+
+    server.create_app(dispatcher=True)
+    for line in sys.stdin:
+        command, *args = line.split()
+        if command == "state":
+            group_id = int(args[0])
+            with server.app.app_context():
+                index = [target.id for target in server.membership_index.targets(group_id=group_id)]
+                plan = server.plan_cache.get((None, group_id, None, int(args[1]), 0))
+            reply = {"leader": server.cluster.is_leader, "index": index,
+                     "plan": [target.intercom_id for target in plan.targets]}
+        elif command == "drain":
+            server.drain()
+            reply = {"drained": True}
+        else:
+            continue
+        print("@@" + json.dumps(reply), flush=True)
+        if command == "drain":
+            return
+
+
+class Node:
+    def __init__(self, name):
+        self.name = name
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--node",
+                                         os.environ["INTERCOM_DATABASE_URI"]], cwd=ROOT,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        text=True)
+
+    def ask(self, line):
+        self.process.stdin.write(line + "\n")
+        self.process.stdin.flush()
+        for output in self.process.stdout:
+            if output.startswith("@@"):
+                return json.loads(output[2:])
+        raise SystemExit(f"{self.name} exited")
+
+    def state(self, group_id, sound_id):
+        return self.ask(f"state {group_id} {sound_id}")
+
+    def wait_for_lead(self, group_id, sound_id):
+        deadline = time.time() + TAKEOVER_TIMEOUT
+        while time.time() < deadline:
+            state = self.state(group_id, sound_id)
+            if state["leader"]:
+                return state
+            time.sleep(0.5)
+        raise SystemExit(f"{self.name} never took over")
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+
+
+def main():
+    scratch = tempfile.mkdtemp(prefix="intercom-failover-")
+    os.environ["INTERCOM_DATABASE_URI"] = f"sqlite:///{scratch}/failover.db"
+    os.environ["INTERCOM_DISPATCHER"] = "0"
+    import server
+
+    server.init_db()
+    with server.app.app_context():
+        first, second = server.Intercom(name="ic1", ip_address="127.0.0.1"), server.Intercom(name="ic2", ip_address="127.0.0.1")
+        sound = server.Sound(name="bell", filename="bell", play_duration_ms=1000)
+        server.db.session.add_all([first, second, sound])
+        server.db.session.commit()
+        group = server.IntercomGroup(name="floor", intercoms=[first])
+        server.db.session.add(group)
+        server.db.session.commit()
+        group_id, sound_id, intercom_ids = group.id, sound.id, [first.id, second.id]
+
+    leader, standby = Node("failover-a"), None
+    try:
+        leader.wait_for_lead(group_id, sound_id)
+        standby = Node("failover-b")
+        before = standby.state(group_id, sound_id)
+        print(f"standby before the edit: index {before['index']}, plan {before['plan']}")
+
+        # The edit comes from a third process, as a web worker on any node would make it
+        response = server.app.test_client().post(f"/groups/edit/{group_id}", data={
+            "name": "floor", "intercom_ids": [str(id) for id in intercom_ids]})
+        if response.status_code != 302:
+            raise SystemExit(f"editing the group returned {response.status_code}")
+
+        leader.ask("drain")
+        after = standby.wait_for_lead(group_id, sound_id)
+        print(f"standby after taking over: index {after['index']}, plan {after['plan']}")
+    finally:
+        for node in (leader, standby):
+            if node:
+                node.stop()
+
+    if after["index"] != intercom_ids or after["plan"] != intercom_ids:
+        raise SystemExit(f"the new dispatcher resolves a stale group (expected {intercom_ids})")
+    print("The new dispatcher picked up the edit.")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--node"]:
+        run_node(sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,147 @@
+"""Lock contention between the dispatcher, edit routes and dashboards.
+
+Runs the same mixed workload against a scratch database twice: once the way
+the server used to open SQLite (rollback journal, one engine), and once with
+the server's tune_sqlite() settings (WAL, busy timeout, separate read-only
+engine). Reports per-operation latency and "database is locked" errors.
+
+    python benchmarks/db_contention.py [--seconds 10] [--readers 8] [--writers 2]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SCRATCH = tempfile.mkdtemp(prefix="intercom-bench-")
+os.environ["INTERCOM_DATABASE_URI"] = f"sqlite:///{SCRATCH}/bench.db"
+
+from sqlalchemy import create_engine, event, exc, select, func, update, insert  # noqa: E402
+
+import server  # noqa: E402
+
+commands = server.AnnouncementCommand.__table__
+intercoms = server.Intercom.__table__
+memberships = server.GroupMembership.__table__
+
+
+def baseline_engines(url):
+    engine = create_engine(url, pool_size=server.DB_POOL_SIZE, max_overflow=server.DB_POOL_SIZE)
+
+    @event.listens_for(engine, "connect")
+    def rollback_journal(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA journal_mode=DELETE")
+
+    return engine, engine
+
+
+def tuned_engines(url):
+    engine = create_engine(url, pool_size=server.DB_POOL_SIZE, max_overflow=server.DB_POOL_SIZE)
+    server.tune_sqlite(engine)
+    read_engine = create_engine(url, pool_size=server.DB_READ_POOL_SIZE, max_overflow=server.DB_READ_POOL_SIZE)
+    server.tune_sqlite(read_engine, read_only=True)
+    return engine, read_engine
+
+
+def seed(engine, n_intercoms=200, n_commands=500):
+    server.db.metadata.drop_all(engine)
+    server.db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(intercoms), [{"name": f"ic{i}", "ip_address": f"10.0.{i // 250}.{i % 250}"}
+                                         for i in range(n_intercoms)])
+        conn.execute(insert(memberships), [{"intercom_id": i + 1, "intercom_group_id": i % 10 + 1}
+                                           for i in range(n_intercoms)])
+        conn.execute(insert(commands), [{"intercom_group_id": i % 10 + 1, "state": "pending", "queued_at": time.time()}
+                                        for i in range(n_commands)])
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, kind, started, error=None):
+        with self.lock:
+            if error:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+            else:
+                self.samples.setdefault(kind, []).append((time.perf_counter() - started) * 1000)
+
+
+def run(label, engines, seconds, readers, writers):
+    write_engine, read_engine = engines
+    seed(write_engine)
+    stats = Stats()
+    stop = time.time() + seconds
+
+    def timed(kind, engine, work):
+        started = time.perf_counter()
+        try:
+            with engine.begin() as conn:
+                work(conn)
+            stats.record(kind, started)
+        except exc.OperationalError as e:
+            stats.record(kind, started, error=e)
+
+    def dispatcher():
+        # CommandStore.flush: a batch of state/progress updates every few ms
+        step = 0
+        while time.time() < stop:
+            step += 1
+            timed("dispatcher write", write_engine, lambda conn: conn.execute(
+                update(commands).where(commands.c.id <= 50).values(step_index=step % 5, state="playing")))
+            time.sleep(0.005)
+
+    def editor():
+        # Edit routes: read a group, then write
+        while time.time() < stop:
+            def edit(conn):
+                conn.execute(select(memberships).where(memberships.c.intercom_group_id == 3)).all()
+                conn.execute(update(intercoms).where(intercoms.c.id == 7).values(volume_modifier=time.time() % 10))
+            timed("edit write", write_engine, edit)
+            time.sleep(0.02)
+
+    def dashboard():
+        # The commands page and queue stats
+        while time.time() < stop:
+            def read(conn):
+                conn.execute(select(commands).where(commands.c.state != "done")).all()
+                conn.execute(select(commands.c.state, func.count()).group_by(commands.c.state)).all()
+                conn.execute(select(intercoms)).all()
+            timed("dashboard read", read_engine, read)
+
+    threads = ([threading.Thread(target=dispatcher)]
+               + [threading.Thread(target=editor) for _ in range(writers)]
+               + [threading.Thread(target=dashboard) for _ in range(readers)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f"\n{label}")
+    print(f"  {'operation':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'errors':>8}")
+    for kind in ("dispatcher write", "edit write", "dashboard read"):
+        values = sorted(stats.samples.get(kind, [])) or [0.0]
+        print(f"  {kind:<18}{len(stats.samples.get(kind, [])):>8}{values[len(values) // 2]:>10.2f}"
+              f"{values[int(len(values) * 0.95)]:>10.2f}{values[-1]:>10.2f}{stats.errors.get(kind, 0):>8}")
+    write_engine.dispose()
+    read_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    args = parser.parse_args()
+
+    url = os.environ["INTERCOM_DATABASE_URI"]
+    run("rollback journal, one engine", baseline_engines(url), args.seconds, args.readers, args.writers)
+    run("WAL + tuned pragmas, read/write engines", tuned_engines(url), args.seconds, args.readers, args.writers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""Dispatcher load benchmark against a simulated intercom fleet.
+
+Starts N simulated intercoms on localhost. Each one answers the port-8084
+sound, playlist, stopall and /status requests with a seeded latency, jitter
+and failure rate, and runs an SFTP stand-in for sound sync. The script then
+drives the server (in-process, through its routes) through three phases:
+
+  sync      push the sound library to every device
+  dispatch  a bell-schedule command set on every floor plus a building-wide
+            announcement, overlapping on the same intercoms
+  stop      a fleet-wide loop, preempted by an emergency set, then
+            "Stop All & Clear Queue"
+
+and reports sync time, dispatch throughput, fan-out time, start_time misses
+(deliveries that reached a device after their start_time), emergency
+trigger-to-audio latency and time-to-silence. Latencies and failures are
+drawn from a fixed seed, so runs are comparable: save one with --out and
+check later runs against it with --compare.
+
+    python benchmarks/fleet_sim.py [--intercoms 100] [--latency-ms 20] [--jitter-ms 10]
+                                   [--failure-rate 0.01] [--seed 1] [--out run.json] [--compare run.json]
+
+The devices listen on 127.0.x.y addresses, which Linux routes to loopback
+out of the box (on macOS, alias them onto lo0 first). The health monitor is
+left off so that injected failures never mark a device down mid-run.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SCRATCH = tempfile.mkdtemp(prefix="intercom-fleet-")
+os.environ["INTERCOM_DATABASE_URI"] = f"sqlite:///{SCRATCH}/fleet.db"
+
+import paramiko  # noqa: E402
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface  # noqa: E402
+
+import server  # noqa: E402
+
+# Metrics where a bigger number is an improvement; everything else is a cost
+HIGHER_IS_BETTER = {"sync_mb_per_s", "dispatch_deliveries_per_s", "worst_start_margin_ms"}
+
+
+# --- Simulated intercoms ---
+class SimIntercom:
+    def __init__(self, index, ip, args):
+        self.index = index
+        self.ip = ip
+        self.latency_ms = args.latency_ms
+        self.jitter_ms = args.jitter_ms
+        self.failure_rate = args.failure_rate
+        self.rng = random.Random(args.seed * 100003 + index)
+        self.root = os.path.join(SCRATCH, "devices", ip)
+        self.lock = threading.Lock()
+        self.deliveries = []  # (received_at, start_time)
+        self.stops = []
+
+    def draw(self):
+        with self.lock:
+            return (self.latency_ms + self.rng.random() * self.jitter_ms) / 1000.0, self.rng.random() < self.failure_rate
+
+    def handle(self, path):
+        url = urlparse(path)
+        if url.path == "/status":
+            with self.lock:
+                playing = bool(self.deliveries) and (not self.stops or self.deliveries[-1][0] > self.stops[-1])
+            return 200, json.dumps({"playing": playing})
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        delay, failed = self.draw()
+        time.sleep(delay)
+        if failed:
+            return 503, "unavailable"
+        received_at = time.time()
+        with self.lock:
+            if params.get("type") in ("sound", "playlist"):
+                self.deliveries.append((received_at, float(params.get("start_time") or 0)))
+            elif params.get("cmd") == "stopall":
+                self.stops.append(received_at)
+        return 200, "ok"
+
+def http_handler(device):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            status, body = device.handle(self.path)
+            body = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+class SftpAuth(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+class SftpHandle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+def sftp_interface(root):
+    # Just enough of a filesystem for SoundSync: stat, open (incl. append), rename
+    def local(path):
+        return os.path.join(root, path.lstrip("/"))
+
+    def errno_of(e):
+        return SFTPServer.convert_errno(e.errno)
+
+    class Interface(SFTPServerInterface):
+        def stat(self, path):
+            try:
+                return SFTPAttributes.from_stat(os.stat(local(path)))
+            except OSError as e:
+                return errno_of(e)
+
+        lstat = stat
+
+        def list_folder(self, path):
+            try:
+                entries = []
+                for name in os.listdir(local(path)):
+                    attrs = SFTPAttributes.from_stat(os.stat(os.path.join(local(path), name)))
+                    attrs.filename = name
+                    entries.append(attrs)
+                return entries
+            except OSError as e:
+                return errno_of(e)
+
+        def open(self, path, flags, attr):
+            try:
+                fd = os.open(local(path), flags, 0o644)
+            except OSError as e:
+                return errno_of(e)
+            if flags & os.O_WRONLY:
+                mode = "ab" if flags & os.O_APPEND else "wb"
+            elif flags & os.O_RDWR:
+                mode = "a+b" if flags & os.O_APPEND else "r+b"
+            else:
+                mode = "rb"
+            handle = SftpHandle(flags)
+            handle.filename = local(path)
+            handle.readfile = handle.writefile = os.fdopen(fd, mode)
+            return handle
+
+        def remove(self, path):
+            try:
+                os.remove(local(path))
+            except OSError as e:
+                return errno_of(e)
+            return paramiko.SFTP_OK
+
+        def rename(self, old, new):
+            try:
+                os.replace(local(old), local(new))
+            except OSError as e:
+                return errno_of(e)
+            return paramiko.SFTP_OK
+
+        posix_rename = rename
+
+    return Interface
+
+def serve_sftp(device, port, host_key):
+    os.makedirs(device.root + server.INTERCOM_SOUND_DIR, exist_ok=True)
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((device.ip, port))
+    listener.listen(16)
+    interface = sftp_interface(device.root)
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, interface)
+            transport.start_server(server=SftpAuth())
+
+    threading.Thread(target=accept, daemon=True).start()
+
+def start_fleet(args):
+    host_key = paramiko.RSAKey.generate(2048)
+    devices = []
+    for index in range(args.intercoms):
+        device = SimIntercom(index, f"127.0.{1 + index // 250}.{1 + index % 250}", args)
+        http = ThreadingHTTPServer((device.ip, server.INTERCOM_HTTP_PORT), http_handler(device))
+        http.daemon_threads = True
+        threading.Thread(target=http.serve_forever, daemon=True).start()
+        serve_sftp(device, args.ssh_port, host_key)
+        devices.append(device)
+    return devices
+
+
+# --- Workload ---
+def write_wav(path, seconds, seed):
+    rng = random.Random(seed)
+    frames = b"".join(struct.pack("<h", rng.randint(-8000, 8000)) for _ in range(int(8000 * seconds)))
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(8000)
+        f.writeframes(frames)
+
+def seed_catalog(devices, args):
+    """Floors of --floor-size intercoms, buildings of five floors, one campus group."""
+    db = server.db
+    db.create_all()
+    intercoms = [server.Intercom(name=f"sim{device.index}", ip_address=device.ip, volume_modifier=0, disabled=False)
+                 for device in devices]
+    db.session.add_all(intercoms)
+    sounds = []
+    for index in range(4):
+        write_wav(os.path.join(server.UPLOAD_FOLDER, f"bench{index}.wav"), args.sound_seconds, args.seed + index)
+        # Played length is kept short so the run doesn't take minutes; the files are full size for sync
+        sounds.append(server.Sound(name=f"bench{index}", filename=f"bench{index}", play_duration_ms=300,
+                                   volume_modifier=0))
+    db.session.add_all(sounds)
+    db.session.flush()
+
+    floors = []
+    for start in range(0, len(intercoms), args.floor_size):
+        floors.append(server.IntercomGroup(name=f"floor{len(floors)}", intercoms=intercoms[start:start + args.floor_size]))
+    db.session.add_all(floors)
+    campus = server.IntercomGroup(name="campus")
+    db.session.add(campus)
+    db.session.flush()
+    for start in range(0, len(floors), 5):
+        building = server.IntercomGroup(name=f"building{start // 5}")
+        db.session.add(building)
+        db.session.flush()
+        db.session.add_all([server.GroupNesting(parent_group_id=building.id, child_group_id=floor.id)
+                            for floor in floors[start:start + 5]])
+        db.session.add(server.GroupNesting(parent_group_id=campus.id, child_group_id=building.id))
+
+    announcement = server.Announcement(name="bench", volume_modifier=0)
+    announcement.set_items([sound.id for sound in sounds[:3]])
+    db.session.add(announcement)
+    db.session.flush()
+
+    bells = [server.SavedCommand(name=f"bell {floor.name}", intercom_group_id=floor.id, sound_id=sounds[3].id,
+                                 volume_modifier=0, times_to_play=2) for floor in floors]
+    campus_announcement = server.SavedCommand(name="campus announcement", intercom_group_id=campus.id,
+                                              announcement_id=announcement.id, volume_modifier=0, times_to_play=1)
+    loop = server.SavedCommand(name="campus loop", intercom_group_id=campus.id, sound_id=sounds[0].id,
+                               volume_modifier=0, loop_forever=True)
+    evacuate = server.SavedCommand(name="evacuate", intercom_group_id=campus.id, announcement_id=announcement.id,
+                                   volume_modifier=0, times_to_play=1, priority=server.EMERGENCY_PRIORITY)
+    db.session.add_all(bells + [campus_announcement, loop, evacuate])
+    db.session.flush()
+    bell_set = server.SavedCommandSet(name="bell schedule", commands=bells)
+    fire_set = server.SavedCommandSet(name="fire", commands=[evacuate])
+    db.session.add_all([bell_set, fire_set])
+    db.session.commit()
+    return {"bells": bell_set.id, "fire": fire_set.id, "announcement": campus_announcement.id, "loop": loop.id}
+
+def wait_idle(timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        snapshot = server.scheduler.snapshot()
+        if not snapshot["active"] and not snapshot["pending"] and not server.scheduler.stepping:
+            return True
+        time.sleep(0.05)
+    return False
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 1) if values else None
+
+def deliveries_since(devices, since):
+    return [(received_at, start_time) for device in devices for received_at, start_time in device.deliveries
+            if received_at >= since]
+
+
+# --- Phases ---
+def run_sync():
+    with server.app.app_context():
+        targets = server.fleet_targets()
+    started = time.time()
+    job = server.sound_sync.start_job(targets)
+    while job.finished_at is None:
+        time.sleep(0.05)
+    seconds = job.finished_at - started
+    moved = sum(status["bytes_done"] for status in job.devices.values())
+    return {
+        "sync_seconds": round(seconds, 2),
+        "sync_mb_per_s": round(moved / seconds / 1e6, 2),
+        "sync_failed_devices": job.to_dict()["failed"],
+    }
+
+def run_dispatch(client, devices, ids, timeout):
+    started = time.time()
+    log_start = len(server.dispatch_log)
+    client.get(f"/saved_command_sets/trigger/{ids['bells']}")
+    client.get(f"/saved_commands/trigger/{ids['announcement']}")
+    if not wait_idle(timeout):
+        print("dispatch phase timed out")
+    steps = [entry for entry in list(server.dispatch_log)[log_start:] if entry["label"].startswith("command ")]
+    delivered = deliveries_since(devices, started)
+    fanout_seconds = sum(entry["elapsed_ms"] for entry in steps) / 1000
+    return {
+        "dispatch_steps": len(steps),
+        "dispatch_deliveries": len(delivered),
+        "dispatch_failed": sum(entry["failed"] for entry in steps),
+        "dispatch_deliveries_per_s": round(sum(entry["sent"] for entry in steps) / fanout_seconds, 1) if fanout_seconds else None,
+        "fanout_p50_ms": percentile([entry["elapsed_ms"] for entry in steps], 0.5),
+        "fanout_p95_ms": percentile([entry["elapsed_ms"] for entry in steps], 0.95),
+        "start_misses": sum(received_at > start_time for received_at, start_time in delivered),
+        "worst_start_margin_ms": percentile([(start_time - received_at) * 1000 for received_at, start_time in delivered], 0),
+    }
+
+def run_stop(client, devices, ids):
+    client.get(f"/saved_commands/trigger/{ids['loop']}")
+    time.sleep(1.5)
+    client.get(f"/saved_command_sets/trigger/{ids['fire']}")
+    time.sleep(1.5)
+    report = client.get("/commands/stopall_full?format=json").get_json()
+    time.sleep(1.0)
+    after_stop = 0
+    for device in devices:
+        if device.stops:
+            after_stop += sum(received_at > device.stops[-1] for received_at, _ in device.deliveries)
+    silence = [d["time_to_silence_ms"] for d in report["devices"] if d["confirmed"]]
+    emergency = server.scheduler.trigger_latency_stats()["emergency"]
+    return {
+        "emergency_trigger_to_audio_ms": emergency.get("max_ms"),
+        "time_to_silence_p50_ms": percentile(silence, 0.5),
+        "time_to_silence_max_ms": report["max_time_to_silence_ms"],
+        "stop_unconfirmed": len(report["unconfirmed"]),
+        "deliveries_after_stop": after_stop,
+    }
+
+def compare(results, baseline, tolerance):
+    print(f"\n{'metric':<32}{'baseline':>12}{'this run':>12}")
+    regressions = []
+    for key, value in results.items():
+        before = baseline.get(key)
+        if key in ("intercoms", "seed") or not isinstance(value, (int, float)) or not isinstance(before, (int, float)):
+            continue
+        if key in HIGHER_IS_BETTER:
+            worse = value < before * (1 - tolerance)
+        else:
+            worse = value > before * (1 + tolerance) and value - before >= 1
+        print(f"{key:<32}{before:>12}{value:>12}{'  <- regression' if worse else ''}")
+        if worse:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--intercoms", type=int, default=100)
+    parser.add_argument("--floor-size", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--failure-rate", type=float, default=0.01)
+    parser.add_argument("--sound-seconds", type=float, default=4, help="length of each synced WAV file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ssh-port", type=int, default=2222)
+    parser.add_argument("--timeout", type=float, default=120, help="give up on the dispatch phase after this long")
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative change before flagging")
+    args = parser.parse_args()
+
+    server.UPLOAD_FOLDER = os.path.join(SCRATCH, "sounds")
+    server.app.config["UPLOAD_FOLDER"] = server.UPLOAD_FOLDER
+    os.makedirs(server.UPLOAD_FOLDER, exist_ok=True)
+    server.INTERCOM_SSH_PORT = args.ssh_port
+    server.STEP_GAP_MS = server.REPEAT_GAP_MS = server.ANNOUNCEMENT_GAP_MS = 100
+
+    devices = start_fleet(args)
+    with server.app.app_context():
+        ids = seed_catalog(devices, args)
+    server.scheduler.start()
+    server.command_store.start()
+    deadline = time.time() + 10
+    while not server.cluster.is_leader and time.time() < deadline:
+        time.sleep(0.05)
+
+    results = {"intercoms": args.intercoms, "seed": args.seed}
+    print(f"{args.intercoms} simulated intercoms, {args.latency_ms} ms + up to {args.jitter_ms} ms, "
+          f"{args.failure_rate:.1%} failures")
+    results.update(run_sync())
+    client = server.app.test_client()
+    results.update(run_dispatch(client, devices, ids, args.timeout))
+    results.update(run_stop(client, devices, ids))
+    server.stop_event.set()
+
+    for key, value in results.items():
+        print(f"  {key:<32}{value}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(f"\n{len(regressions)} metric(s) regressed: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
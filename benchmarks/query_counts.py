@@ -0,0 +1,119 @@
+"""Queries per dashboard page at two catalog sizes.
+
+Seeds a scratch database with a small and a large catalog and counts the SQL
+statements each GET route runs, with the lookup cache cold and warm. A route
+whose count grows with the number of rows is an N+1 or a full-table load;
+the script exits non-zero if it finds one.
+
+    python benchmarks/query_counts.py [--small 5] [--large 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SCRATCH = tempfile.mkdtemp(prefix="intercom-queries-")
+os.environ["INTERCOM_DATABASE_URI"] = f"sqlite:///{SCRATCH}/queries.db"
+
+from sqlalchemy import event  # noqa: E402
+
+import server  # noqa: E402
+
+ROUTES = [
+    "/", "/intercoms", "/intercoms/edit/1", "/intercoms/status", "/groups", "/groups/add", "/groups/edit/1",
+    "/sounds", "/announcements", "/announcements/add", "/announcements/edit/1", "/commands", "/commands/add",
+    "/commands/queue_stats", "/saved_commands", "/saved_commands/add", "/saved_commands/edit/1",
+    "/saved_command_sets", "/saved_command_sets/add", "/saved_command_sets/edit/1",
+    "/schedules", "/schedules/add", "/schedules/edit/1",
+]
+
+
+def seed(n):
+    db = server.db
+    db.drop_all()
+    db.create_all()
+    intercoms = [server.Intercom(name=f"ic{i}", ip_address=f"10.0.{i // 250}.{i % 250}") for i in range(n)]
+    sounds = [server.Sound(name=f"s{i}", filename=f"s{i}", play_duration_ms=1000) for i in range(n)]
+    db.session.add_all(intercoms + sounds)
+    db.session.flush()
+    groups = [server.IntercomGroup(name=f"g{i}", intercoms=intercoms[i:i + 5]) for i in range(n)]
+    announcements = []
+    for i in range(n):
+        announcement = server.Announcement(name=f"a{i}", volume_modifier=0)
+        announcement.set_items([sounds[i].id, sounds[(i + 1) % n].id])
+        announcements.append(announcement)
+    db.session.add_all(groups + announcements)
+    db.session.flush()
+    saved = [server.SavedCommand(name=f"sc{i}", intercom_group_id=groups[i].id, announcement_id=announcements[i].id)
+             for i in range(n)]
+    db.session.add_all(saved)
+    db.session.flush()
+    db.session.add_all([server.SavedCommandSet(name=f"set{i}", commands=saved[i:i + 3]) for i in range(n)])
+    db.session.add_all([server.Schedule(name=f"sch{i}", cron="0 8 * * 1-5", saved_command_id=saved[i].id)
+                        for i in range(n)])
+    db.session.add_all([server.AnnouncementCommand(intercom_group_id=groups[i].id, announcement_id=announcements[i].id)
+                        for i in range(n)])
+    db.session.commit()
+
+
+def count_queries(client, engines, path):
+    count = [0]
+    # Routes marked @dispatcher_state look up the dispatcher's address once per lease; that's not the page's cost
+    server.dispatch_notifier.dispatcher_http_address()
+
+    def counter(*args):
+        count[0] += 1
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", counter)
+    try:
+        response = client.get(path)
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", counter)
+    if response.status_code != 200:
+        raise SystemExit(f"{path} returned {response.status_code}")
+    return count[0]
+
+
+def measure(n):
+    with server.app.app_context():
+        seed(n)
+        engines = [server.db.engine, server.read_engine]
+    client = server.app.test_client()
+    results = {}
+    for path in ROUTES:
+        server.catalog.invalidate()
+        server.membership_index.invalidate()
+        cold = count_queries(client, engines, path)
+        warm = count_queries(client, engines, path)
+        results[path] = (cold, warm)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--small", type=int, default=5)
+    parser.add_argument("--large", type=int, default=200)
+    args = parser.parse_args()
+
+    small = measure(args.small)
+    large = measure(args.large)
+    print(f"{'route':<30}{'cold':>14}{'warm':>14}")
+    print(f"{'':<30}{f'{args.small} / {args.large} rows':>14}{f'{args.small} / {args.large} rows':>14}")
+    failures = []
+    for path in ROUTES:
+        (small_cold, small_warm), (large_cold, large_warm) = small[path], large[path]
+        flag = ""
+        if (small_cold, small_warm) != (large_cold, large_warm):
+            failures.append(path)
+            flag = "  <- grows with rows"
+        print(f"{path:<30}{f'{small_cold} / {large_cold}':>14}{f'{small_warm} / {large_warm}':>14}{flag}")
+    if failures:
+        raise SystemExit(f"{len(failures)} route(s) scale with the catalog: {', '.join(failures)}")
+    print("Every route runs a constant number of queries.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,232 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, send_from_directory
+from flask import Flask, Request, Response, has_app_context, request, jsonify, render_template, redirect, url_for, flash, send_from_directory, stream_with_context
+from werkzeug.serving import WSGIRequestHandler, make_server
 from werkzeug.utils import secure_filename
 from flask_sqlalchemy import SQLAlchemy
-from queue import Queue
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import scoped_session, selectinload, sessionmaker
+from concurrent.futures import ThreadPoolExecutor
+import queue
+from collections import OrderedDict, deque, namedtuple
+from urllib.parse import urlencode
+import functools
 import threading
 import time
 import os
 import signal
+import socket
+import sys
 import requests
 import paramiko
 import wave
 import json
+import math
+import heapq
+import itertools
+import bisect
+import hashlib
+import tempfile
+from datetime import datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:  # only needed for rendered announcements and upload format conversion
+    np = None
 
 UPLOAD_FOLDER = "/home/james/server/sounds"
 ALLOWED_EXTENSIONS = {'wav'}
 INTERCOM_USERNAME = "<USERNAME>"
 INTERCOM_PASSWORD = "<PASSWORD>"
+INTERCOM_HTTP_PORT = 8084
+INTERCOM_SSH_PORT = 22
+INTERCOM_SOUND_DIR = "/var/sounds"
+
+# Dispatch fan-out: max in-flight requests per step and per-request timeout (s)
+DISPATCH_CONCURRENCY = 64
+DISPATCH_TIMEOUT = 1
+DISPATCH_LOG_SIZE = 200
+
+# Global stop: timeout for the first broadcast and for the retry pass to devices that didn't confirm (s)
+STOP_TIMEOUT = 1
+STOP_RETRY_TIMEOUT = 2
+
+# start_time lead: estimated fan-out time * margin + base, clamped to [min, max] (ms)
+LEAD_TIME_BASE_MS = 150
+LEAD_TIME_MARGIN = 1.5
+LEAD_TIME_MIN_MS = 250
+LEAD_TIME_MAX_MS = 10000
+LATENCY_HISTORY_SIZE = 50
+
+# Sound sync: concurrent SSH sessions, upload chunk size, finished jobs kept for status
+SYNC_CONCURRENCY = 16
+SYNC_CHUNK_SIZE = 256 * 1024
+SYNC_JOB_HISTORY = 20
+SYNC_MANIFEST_NAME = ".manifest.json"
+SYNC_RETRY_SECONDS = 60
+
+# What the dispatcher does with a target that doesn't have a step's sound yet: "skip", "warn" or "ignore"
+MISSING_SOUND_POLICY = "skip"
+
+# Health monitor: probe every device this often, with its own pool and timeout;
+# a device counts as down after HEALTH_DOWN_AFTER consecutive failed probes
+HEALTH_PROBE_INTERVAL = 15
+HEALTH_PROBE_TIMEOUT = 1
+HEALTH_CONCURRENCY = 32
+HEALTH_DOWN_AFTER = 2
+
+# Server-sent events: per-client buffer (slow clients drop events) and keepalive interval (s)
+EVENT_QUEUE_SIZE = 500
+EVENT_KEEPALIVE = 15
+
+# Silence between the end of one sound and the start_time of the next (ms)
+STEP_GAP_MS = 2000
+REPEAT_GAP_MS = 2000
+
+# "stepwise" sends one request per sound; "playlist" sends each intercom the whole
+# announcement in one request (type=playlist); "rendered" plays a server-rendered
+# WAV of the whole announcement. Items are spaced ANNOUNCEMENT_GAP_MS apart.
+ANNOUNCEMENT_DISPATCH_MODE = "stepwise"
+ANNOUNCEMENT_GAP_MS = 500
+
+# Rendered announcements are written to UPLOAD_FOLDER (so they sync like any
+# other sound) and evicted least-recently-used beyond this many bytes
+RENDER_CACHE_BYTES = 200 * 1024 * 1024
+RENDER_PREFIX = "_render_"
+
+# Uploads stream into UPLOAD_FOLDER/.incoming and are moved into place once
+# validated. DEVICE_* is the format the intercoms expect (None keeps whatever
+# was uploaded); converting runs on a background worker and needs NumPy.
+MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+INCOMING_FOLDER_NAME = ".incoming"
+DEVICE_SAMPLE_RATE = None
+DEVICE_CHANNELS = None
+DEVICE_SAMPLE_WIDTH = None
+
+# Loudness normalization: sounds are measured as gated RMS (dBFS, LUFS-style
+# gating without K-weighting) and scaled toward LOUDNESS_TARGET_DB by a gain
+# on their final volume. "suggest" only shows the gains on the sounds page,
+# "apply" sets them as sounds are analyzed, "off" skips analysis after uploads.
+LOUDNESS_NORMALIZATION = "suggest"
+LOUDNESS_TARGET_DB = -20.0
+LOUDNESS_MIN_GAIN = 0.25
+LOUDNESS_MAX_GAIN = 4.0
+
+SCHEDULER_WORKERS = 8
+
+# Durable queue: AnnouncementCommand rows carry the state and progress of each
+# command. This node leases the rows it is playing and renews the lease; rows
+# whose lease lapses (crash, restart) are claimed again and resumed. State is
+# written every QUEUE_FLUSH_INTERVAL seconds; done rows are kept this long (s).
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}"
+QUEUE_LEASE_SECONDS = 10
+# Several processes can share one database. Each serves the UI and accepts
+# commands; only the elected dispatcher (holder of a lease renewed every
+# QUEUE_FLUSH_INTERVAL) drives intercoms. Set INTERCOM_DISPATCHER=0 for web-only nodes.
+DATABASE_URI = os.environ.get("INTERCOM_DATABASE_URI", "sqlite:///intercom.db")
+HTTP_PORT = int(os.environ.get("INTERCOM_PORT", 8000))
+DISPATCHER_ENABLED = os.environ.get("INTERCOM_DISPATCHER", "1") != "0"
+LEADER_LEASE_SECONDS = 5
+
+# Serving: WSGI workers (gunicorn "server:create_app()") only serve the UI and
+# queue commands; `python server.py dispatcher` drives the intercoms. Workers
+# nudge the dispatcher with a UDP datagram when they queue a command or a sound
+# push, so it doesn't wait for its next poll. The dispatcher listens on
+# DISPATCH_NOTIFY_HOST (use an address the web hosts can reach when they're
+# elsewhere) and publishes the port in the database. On SIGTERM it finishes
+# in-flight steps, saves progress and hands its commands over, waiting at most
+# DRAIN_TIMEOUT seconds. Live state (events, metrics, latency, health, sync
+# jobs) only exists in the dispatcher, so it also serves the app on an internal
+# HTTP port and workers relay those routes to it, waiting up to RELAY_TIMEOUT
+# for each chunk. /events streams hold a worker thread each: use threaded or
+# async workers (gunicorn -k gthread or -k gevent), not the default sync ones.
+DISPATCH_NOTIFY_HOST = os.environ.get("INTERCOM_NOTIFY_HOST", "127.0.0.1")
+DRAIN_TIMEOUT = 10
+RELAY_TIMEOUT = EVENT_KEEPALIVE * 2
+
+# Database: SQLite runs in WAL mode so dashboard reads don't block the
+# dispatcher's writes, and writers wait up to DB_BUSY_TIMEOUT_MS for each
+# other instead of failing with "database is locked". Polled read-only views
+# use a separate read-only engine with its own pool.
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_KB = 20000
+DB_POOL_SIZE = 10
+DB_READ_POOL_SIZE = 10
+
+# List pages show this many rows per page; id -> name lookups for the catalog
+# tables are cached until a local commit changes them, or this many seconds
+# (edits made on other nodes)
+PAGE_SIZE = 50
+LOOKUP_CACHE_TTL = 30
+QUEUE_FLUSH_INTERVAL = 1
+QUEUE_DONE_RETENTION = 3600
+QUEUE_WAIT_HISTORY_SIZE = 500
+
+# Metrics are served at /metrics in the Prometheus text format. TRACE_LOG, if
+# set, is a JSON-lines file with one record per command event (triggered,
+# admitted, each step, preempted, finished). Dispatch only prints steps that
+# had failed or late deliveries unless VERBOSE_DISPATCH_LOG is set.
+TRACE_LOG = os.environ.get("INTERCOM_TRACE_LOG")
+VERBOSE_DISPATCH_LOG = False
+
+# Higher priority plays first and preempts lower priority on shared intercoms.
+# Commands at or above EMERGENCY_PRIORITY are tracked separately for trigger-to-audio latency.
+DEFAULT_PRIORITY = 100
+EMERGENCY_PRIORITY = 200
+TRIGGER_LATENCY_HISTORY_SIZE = 200
+
+# /api/trigger remembers each Idempotency-Key (and the commands it created)
+# this long; a retry with the same key within it doesn't queue anything again
+IDEMPOTENCY_KEY_TTL = 24 * 3600
+
+# Schedules fire from a timer heap on the dispatcher. SCHEDULE_PREPARE_SECONDS
+# before a fire time its plans are compiled and the fan-out lead estimated; the
+# commands are queued (and their first requests sent) that lead plus
+# SCHEDULE_ADMIT_MARGIN seconds early, so the shared start_time lands on the
+# scheduled second.
+SCHEDULE_PREPARE_SECONDS = 15
+SCHEDULE_ADMIT_MARGIN = 0.5
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///intercom.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_POOL_SIZE}
 app.config['SECRET_KEY'] = 'dev'
 app.template_folder = "templates"
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 
 
 os.makedirs("templates", exist_ok=True)
 
 db = SQLAlchemy(app)
-command_queue = Queue()
 stop_event = threading.Event()
 
+def tune_sqlite(engine, read_only=False):
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")  # durable at checkpoints; safe with WAL
+        cursor.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+with app.app_context():
+    tune_sqlite(db.engine)
+    read_engine = create_engine(db.engine.url, pool_size=DB_READ_POOL_SIZE, max_overflow=DB_READ_POOL_SIZE)
+    tune_sqlite(read_engine, read_only=True)
+# Per-thread session on the read-only engine, closed with the app context
+read_session = scoped_session(sessionmaker(bind=read_engine))
+
+@app.teardown_appcontext
+def remove_read_session(exception=None):
+    read_session.remove()
+
 # --- Models ---
 class Intercom(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -42,11 +239,20 @@ class IntercomGroup(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100))
     intercoms = db.relationship('Intercom', secondary='group_membership')
+    subgroups = db.relationship('IntercomGroup', secondary='group_nesting',
+                                primaryjoin='IntercomGroup.id == GroupNesting.parent_group_id',
+                                secondaryjoin='IntercomGroup.id == GroupNesting.child_group_id')
 
 class GroupMembership(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    intercom_id = db.Column(db.Integer, db.ForeignKey('intercom.id'))
-    intercom_group_id = db.Column(db.Integer, db.ForeignKey('intercom_group.id'))
+    intercom_id = db.Column(db.Integer, db.ForeignKey('intercom.id'), index=True)
+    intercom_group_id = db.Column(db.Integer, db.ForeignKey('intercom_group.id'), index=True)
+
+class GroupNesting(db.Model):
+    # A group included in another one (campus -> building -> floor)
+    id = db.Column(db.Integer, primary_key=True)
+    parent_group_id = db.Column(db.Integer, db.ForeignKey('intercom_group.id'), index=True)
+    child_group_id = db.Column(db.Integer, db.ForeignKey('intercom_group.id'), index=True)
 
 class Sound(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -54,33 +260,103 @@ class Sound(db.Model):
     filename = db.Column(db.String(200))
     play_duration_ms = db.Column(db.Integer)
     volume_modifier = db.Column(db.Integer, default=0)
+    # Filled in from the WAV header by the upload pipeline
+    sample_rate = db.Column(db.Integer)
+    channels = db.Column(db.Integer)
+    sample_width = db.Column(db.Integer)
+    file_size = db.Column(db.Integer)
+    sha256 = db.Column(db.String(64))
+    status = db.Column(db.String(20), default="ready")  # "processing" while being converted, or "failed"
+    # Loudness analysis, cached against the hash of the file it was measured on
+    loudness_db = db.Column(db.Float)
+    peak_db = db.Column(db.Float)
+    loudness_sha256 = db.Column(db.String(64))
+    loudness_gain = db.Column(db.Float, default=1.0)  # multiplies the final volume
 
 class Announcement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100))
     volume_modifier = db.Column(db.Integer, default=0)
-    sound_order = db.Column(db.Text)  # Comma-separated list of sound IDs
+    items = db.relationship("AnnouncementItem", order_by="AnnouncementItem.position",
+                            cascade="all, delete-orphan", backref="announcement")
+
+    def set_items(self, sound_ids, volumes=(), gaps=()):
+        """Replace the sequence; volumes and gaps line up with sound_ids (blank = default)."""
+        self.items = [
+            AnnouncementItem(position=position, sound_id=int(sound_id),
+                             volume_modifier=int(volume) if volume not in (None, "") else 0,
+                             gap_ms=int(gap) if gap not in (None, "") else None)
+            for position, (sound_id, volume, gap) in enumerate(itertools.zip_longest(sound_ids, volumes, gaps))
+            if sound_id
+        ]
+
+class AnnouncementItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    announcement_id = db.Column(db.Integer, db.ForeignKey('announcement.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    sound_id = db.Column(db.Integer, db.ForeignKey('sound.id'), nullable=False, index=True)
+    volume_modifier = db.Column(db.Integer, default=0)
+    gap_ms = db.Column(db.Integer)  # silence after this item; None uses the dispatch mode's default
+    sound = db.relationship("Sound")
+    __table_args__ = (db.UniqueConstraint("announcement_id", "position"),)
 
 class AnnouncementCommand(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    intercom_id = db.Column(db.Integer, db.ForeignKey('intercom.id'), nullable=True)
-    intercom_group_id = db.Column(db.Integer, db.ForeignKey('intercom_group.id'), nullable=True)
+    intercom_id = db.Column(db.Integer, db.ForeignKey('intercom.id'), nullable=True, index=True)
+    intercom_group_id = db.Column(db.Integer, db.ForeignKey('intercom_group.id'), nullable=True, index=True)
     announcement_id = db.Column(db.Integer, db.ForeignKey('announcement.id'), nullable=True)
     sound_id = db.Column(db.Integer, db.ForeignKey('sound.id'), nullable=True)
     volume_modifier = db.Column(db.Integer, default=50)
     times_to_play = db.Column(db.Integer, default=1)
     loop_forever = db.Column(db.Boolean, default=False)
+    priority = db.Column(db.Integer, default=DEFAULT_PRIORITY)
+    # Queue state: pending -> dispatching -> playing -> done, plus where playback has got to
+    state = db.Column(db.String(20), default="pending", index=True)
+    queued_at = db.Column(db.Float, default=lambda: time.time())
+    finished_at = db.Column(db.Float)
+    repetition = db.Column(db.Integer, default=0)
+    step_index = db.Column(db.Integer, default=0)
+    lease_owner = db.Column(db.String(100))  # unleased until the dispatcher claims it
+    lease_expires = db.Column(db.Float, index=True)
+    start_at = db.Column(db.Float)  # scheduled commands: the first step's start_time
+
+class Schedule(db.Model):
+    # A cron rule that fires a saved command or a saved command set
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100))
+    cron = db.Column(db.String(100))
+    saved_command_id = db.Column(db.Integer, db.ForeignKey('saved_command.id'), nullable=True)
+    command_set_id = db.Column(db.Integer, db.ForeignKey('saved_command_set.id'), nullable=True)
+    enabled = db.Column(db.Boolean, default=True)
+    last_fired_at = db.Column(db.Float)  # the scheduled time it last fired for
+
+class TriggerRequest(db.Model):
+    # An Idempotency-Key seen by /api/trigger and what it queued
+    key = db.Column(db.String(200), primary_key=True)
+    fingerprint = db.Column(db.String(64))  # sha256 of the request, to catch a key reused for something else
+    command_ids = db.Column(db.Text)  # JSON list
+    created_at = db.Column(db.Float, index=True)
+
+class ClusterState(db.Model):
+    # Shared between server processes: the "dispatcher" leader lease and the "catalog" version
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(100))
+    expires = db.Column(db.Float)
+    version = db.Column(db.Integer, default=0)
+    address = db.Column(db.String(100))  # dispatcher's notify address (host:port)
+    http_address = db.Column(db.String(100))  # dispatcher's internal HTTP address (host:port)
 
 class SavedCommand(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100))
-    intercom_id = db.Column(db.Integer, db.ForeignKey('intercom.id'), nullable=True)
-    intercom_group_id = db.Column(db.Integer, db.ForeignKey('intercom_group.id'), nullable=True)
+    intercom_id = db.Column(db.Integer, db.ForeignKey('intercom.id'), nullable=True, index=True)
+    intercom_group_id = db.Column(db.Integer, db.ForeignKey('intercom_group.id'), nullable=True, index=True)
     announcement_id = db.Column(db.Integer, db.ForeignKey('announcement.id'), nullable=True)
     sound_id = db.Column(db.Integer, db.ForeignKey('sound.id'), nullable=True)
     volume_modifier = db.Column(db.Integer, default=50)
     times_to_play = db.Column(db.Integer, default=1)
     loop_forever = db.Column(db.Boolean, default=False)
+    priority = db.Column(db.Integer, default=DEFAULT_PRIORITY)
 
 class SavedCommandSet(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -89,8 +365,69 @@ class SavedCommandSet(db.Model):
 
 class SavedCommandSetMembership(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    saved_command_id = db.Column(db.Integer, db.ForeignKey('saved_command.id'))
-    set_id = db.Column(db.Integer, db.ForeignKey('saved_command_set.id'))
+    saved_command_id = db.Column(db.Integer, db.ForeignKey('saved_command.id'), index=True)
+    set_id = db.Column(db.Integer, db.ForeignKey('saved_command_set.id'), index=True)
+
+
+def _sql_literal(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def upgrade_schema():
+    # create_all() only creates missing tables, so add columns introduced since
+    # an existing intercom.db was created
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}"
+                if column.default is not None and column.default.is_scalar:
+                    ddl += f" DEFAULT {_sql_literal(column.default.arg)}"
+                print(f"Upgrading schema: {ddl}")
+                conn.execute(db.text(ddl))
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    print(f"Upgrading schema: creating index {index.name}")
+                    index.create(conn)
+
+
+def migrate_sound_order():
+    # Announcements used to keep their sequence as a CSV of sound IDs in
+    # announcement.sound_order; move any that are left into AnnouncementItem
+    inspector = db.inspect(db.engine)
+    if "sound_order" not in {column["name"] for column in inspector.get_columns("announcement")}:
+        return
+    rows = db.session.execute(db.text(
+        "SELECT id, sound_order FROM announcement WHERE sound_order IS NOT NULL AND sound_order != ''")).all()
+    existing = {sound.id for sound in Sound.query.all()}
+    for announcement_id, sound_order in rows:
+        # Claimed in the same transaction as its items: when several workers
+        # start at once, the others wait on the write lock and then skip it
+        claimed = db.session.execute(db.text(
+            "UPDATE announcement SET sound_order = NULL WHERE id = :id AND sound_order = :sound_order"),
+            {"id": announcement_id, "sound_order": sound_order}).rowcount
+        if not claimed:
+            db.session.rollback()
+            continue
+        sound_ids = [int(sid) for sid in sound_order.split(",") if sid.strip()]
+        dropped = [sid for sid in sound_ids if sid not in existing]
+        if dropped:
+            print(f"Announcement {announcement_id}: dropping deleted sound(s) {dropped}")
+        announcement = Announcement.query.get(announcement_id)
+        announcement.set_items([sid for sid in sound_ids if sid in existing])
+        db.session.commit()
+        print(f"Migrated announcement {announcement_id} sound order to {len(announcement.items)} item(s)")
+    db.session.execute(db.text("UPDATE announcement SET sound_order = NULL WHERE sound_order = ''"))
+    db.session.commit()
 
 
 def allowed_file(filename):
@@ -103,90 +440,2691 @@ def get_wav_duration_ms(filepath):
         duration_seconds = frames / float(rate)
         return int(duration_seconds * 1000)  # convert to ms
 
-# --- Queue Processor ---
-def process_queue():
-    import requests
-    while not stop_event.is_set():
+# --- Catalog Lookups ---
+Named = namedtuple("Named", "id name")
+Page = namedtuple("Page", "items page pages total")
+
+class CatalogLookup:
+    """id -> name maps of the catalog tables, for dropdowns and list pages.
+
+    Each table is loaded with one query on the read engine and dropped after
+    any commit in this process that adds, changes or deletes a catalog row.
+    """
+
+    def __init__(self, ttl=LOOKUP_CACHE_TTL):
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.generation = 0
+        self.ttl = ttl
+
+    @property
+    def models(self):
+        return {"intercoms": Intercom, "groups": IntercomGroup, "announcements": Announcement,
+                "sounds": Sound, "saved_commands": SavedCommand,
+                "command_sets": SavedCommandSet}
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.tables.clear()
+
+    def names(self, table):
+        with self.lock:
+            cached = self.tables.get(table)
+            generation = self.generation
+        if cached and time.time() - cached[0] < self.ttl:
+            return cached[1]
+        model = self.models[table]
+        names = dict(read_session.query(model.id, model.name).order_by(model.id).all())
+        with self.lock:
+            if generation == self.generation:  # not invalidated while loading
+                self.tables[table] = (time.time(), names)
+        return names
+
+    def options(self, table):
+        return [Named(id, name) for id, name in self.names(table).items()]
+
+catalog = CatalogLookup()
+
+@event.listens_for(db.session, "after_flush")
+def note_catalog_changes(session, flush_context):
+    models = tuple(catalog.models.values())
+    if any(isinstance(obj, models) for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info["catalog_changed"] = True
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_catalog(session):
+    if session.info.pop("catalog_changed", False):
+        catalog.invalidate()
+
+def paginate(query, per_page=PAGE_SIZE):
+    # ?page=N, counted and sliced in the database
+    page = max(request.args.get("page", 1, type=int), 1)
+    total = query.order_by(None).count()
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    return Page(items, page, max(1, math.ceil(total / per_page)), total)
+
+
+# --- Group Membership Index ---
+IntercomInfo = namedtuple("IntercomInfo", "id name ip_address volume_modifier disabled")
+
+class MembershipIndex:
+    """Nested groups flattened to sets of enabled intercoms.
+
+    Loaded with three queries on first use, then kept current by the routes
+    that edit intercoms and groups. A group's expansion is computed once and
+    kept until it (or one of the groups or intercoms under it) changes, so
+    resolving a command's targets is a dictionary lookup.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.intercoms = {}     # id -> IntercomInfo
+        self.members = {}       # group id -> direct intercom ids
+        self.children = {}      # group id -> child group ids
+        self.parents = {}       # group id -> parent group ids
+        self.member_of = {}     # intercom id -> group ids it's directly in
+        self.expanded = {}      # group id -> frozenset of enabled intercom ids
+
+    @staticmethod
+    def info(intercom):
+        return IntercomInfo(intercom.id, intercom.name, intercom.ip_address,
+                            intercom.volume_modifier or 0, bool(intercom.disabled))
+
+    def invalidate(self):
+        # Reload on next use; for edits made on another node
+        with self.lock:
+            self.loaded = False
+
+    def _load(self):
+        self.intercoms = {intercom.id: self.info(intercom) for intercom in Intercom.query.all()}
+        self.members, self.children, self.parents, self.member_of = {}, {}, {}, {}
+        self.expanded = {}
+        for (group_id,) in db.session.query(IntercomGroup.id):
+            self.members[group_id] = set()
+            self.children[group_id] = set()
+        for intercom_id, group_id in db.session.query(GroupMembership.intercom_id, GroupMembership.intercom_group_id):
+            self.members.setdefault(group_id, set()).add(intercom_id)
+            self.member_of.setdefault(intercom_id, set()).add(group_id)
+        for parent_id, child_id in db.session.query(GroupNesting.parent_group_id, GroupNesting.child_group_id):
+            self.children.setdefault(parent_id, set()).add(child_id)
+            self.parents.setdefault(child_id, set()).add(parent_id)
+        self.loaded = True
+
+    def _ensure(self):
+        if not self.loaded:
+            self._load()
+
+    def _reach(self, group_ids, links):
+        # Every group reachable from group_ids through links, themselves included
+        seen = set()
+        stack = list(group_ids)
+        while stack:
+            group_id = stack.pop()
+            if group_id not in seen:
+                seen.add(group_id)
+                stack.extend(links.get(group_id, ()))
+        return seen
+
+    def _drop_expansions(self, group_ids):
+        for group_id in self._reach(group_ids, self.parents):
+            self.expanded.pop(group_id, None)
+
+    def _expand(self, group_id, visiting):
+        cached = self.expanded.get(group_id)
+        if cached is not None:
+            return cached
+        visiting.add(group_id)
+        ids = {intercom_id for intercom_id in self.members.get(group_id, ())
+               if intercom_id in self.intercoms and not self.intercoms[intercom_id].disabled}
+        for child_id in self.children.get(group_id, ()):
+            if child_id not in visiting:
+                ids |= self._expand(child_id, visiting)
+        visiting.discard(group_id)
+        result = self.expanded[group_id] = frozenset(ids)
+        return result
+
+    def expand(self, group_id):
+        with self.lock:
+            self._ensure()
+            return self._expand(group_id, set())
+
+    def targets(self, intercom_id=None, group_id=None):
+        """Enabled intercoms for a command target, each once, in id order."""
+        with self.lock:
+            self._ensure()
+            if intercom_id:
+                ids = [intercom_id]
+            elif group_id:
+                ids = sorted(self._expand(group_id, set()))
+            else:
+                ids = []
+            return [self.intercoms[id] for id in ids if id in self.intercoms and not self.intercoms[id].disabled]
+
+    def descendants(self, group_id):
+        with self.lock:
+            self._ensure()
+            return self._reach([group_id], self.children)
+
+    def ancestors(self, group_id):
+        with self.lock:
+            self._ensure()
+            return self._reach([group_id], self.parents)
+
+    def put_intercom(self, intercom):
+        with self.lock:
+            if not self.loaded:
+                return
+            old = self.intercoms.get(intercom.id)
+            self.intercoms[intercom.id] = info = self.info(intercom)
+            if old is None or old.disabled != info.disabled:
+                self._drop_expansions(self.member_of.get(intercom.id, ()))
+
+    def drop_intercom(self, intercom_id):
+        with self.lock:
+            if not self.loaded:
+                return
+            self.intercoms.pop(intercom_id, None)
+            group_ids = self.member_of.pop(intercom_id, set())
+            for group_id in group_ids:
+                self.members.get(group_id, set()).discard(intercom_id)
+            self._drop_expansions(group_ids)
+
+    def put_group(self, group_id, intercom_ids, child_ids):
+        with self.lock:
+            if not self.loaded:
+                return
+            for intercom_id in self.members.get(group_id, ()):
+                self.member_of.get(intercom_id, set()).discard(group_id)
+            for child_id in self.children.get(group_id, ()):
+                self.parents.get(child_id, set()).discard(group_id)
+            self.members[group_id] = set(intercom_ids)
+            self.children[group_id] = set(child_ids)
+            for intercom_id in intercom_ids:
+                self.member_of.setdefault(intercom_id, set()).add(group_id)
+            for child_id in child_ids:
+                self.parents.setdefault(child_id, set()).add(group_id)
+            self._drop_expansions([group_id])
+
+    def drop_group(self, group_id):
+        with self.lock:
+            if not self.loaded:
+                return
+            self.put_group(group_id, (), ())
+            for parent_id in self.parents.pop(group_id, set()):
+                self.children.get(parent_id, set()).discard(group_id)
+            self.members.pop(group_id, None)
+            self.children.pop(group_id, None)
+
+membership_index = MembershipIndex()
+
+
+# --- Event Stream ---
+class EventBus:
+    """Fans dashboard events out to every connected /events client."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, kind, data):
+        message = f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass
+
+event_bus = EventBus()
+
+def command_row(cmd):
+    # Everything commands.html shows for a queued command
+    def name_of(table, id):
+        return catalog.names(table).get(id, "") if id else ""
+
+    return {
+        "id": cmd.id,
+        "intercom": name_of("intercoms", cmd.intercom_id),
+        "group": name_of("groups", cmd.intercom_group_id),
+        "announcement": name_of("announcements", cmd.announcement_id),
+        "sound": name_of("sounds", cmd.sound_id),
+        "volume_modifier": cmd.volume_modifier,
+        "times_to_play": cmd.times_to_play,
+        "loop_forever": cmd.loop_forever,
+        "priority": cmd.priority,
+    }
+
+# --- Metrics ---
+class Histogram:
+    """Prometheus-style histogram with fixed buckets, one series per label set."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> per-bucket counts (last one is +Inf), then the sum
+
+    def observe(self, value, *label_values):
+        self.observe_many((value,), *label_values)
+
+    def observe_many(self, values, *label_values):
+        # One lock round trip for a whole step's worth of samples
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for value in values:
+                series[bisect.bisect_left(self.buckets, value)] += 1
+                series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = dict(zip(self.labels, label_values))
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                total += count
+                yield self.name + "_bucket", dict(labels, le="+Inf" if bound == float("inf") else repr(bound)), total
+            yield self.name + "_sum", labels, values[-1]
+            yield self.name + "_count", labels, total
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {} if labels else {(): 0}
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            series = dict(self.series)
+        for label_values, value in sorted(series.items()):
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+class Gauge:
+    """Read when scraped: fn returns a number, or {label values: number}."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = tuple(labels)
+
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+class Metrics:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MARGIN_BUCKETS = (-1, -0.25, -0.1, -0.05, 0, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+request_seconds = metrics.add(Histogram(
+    "intercom_request_seconds", "Round trip of each request to an intercom", LATENCY_BUCKETS, ("kind", "outcome")))
+fanout_seconds = metrics.add(Histogram(
+    "intercom_fanout_seconds", "Time to send one step to all of its intercoms", LATENCY_BUCKETS, ("kind",)))
+start_margin_seconds = metrics.add(Histogram(
+    "intercom_start_margin_seconds", "start_time minus when each intercom acknowledged the step (negative is late)",
+    MARGIN_BUCKETS))
+late_deliveries = metrics.add(Counter(
+    "intercom_late_deliveries_total", "Steps acknowledged after their start_time"))
+queue_wait_seconds = metrics.add(Histogram(
+    "intercom_queue_wait_seconds", "Time from queued to first dispatch", LATENCY_BUCKETS + (30, 60, 300)))
+sync_bytes = metrics.add(Counter("intercom_sync_bytes_total", "Bytes uploaded to intercoms by sound sync"))
+sync_files = metrics.add(Counter("intercom_sync_files_total", "Files uploaded to intercoms by sound sync"))
+sync_device_seconds = metrics.add(Histogram(
+    "intercom_sync_device_seconds", "Time to sync one intercom", (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900), ("outcome",)))
+db_query_seconds = metrics.add(Histogram("intercom_db_query_seconds", "SQL statement time", QUERY_BUCKETS, ("engine",)))
+
+def instrument_engine(engine, name):
+    @event.listens_for(engine, "before_cursor_execute")
+    def query_started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def query_finished(conn, cursor, statement, parameters, context, executemany):
+        db_query_seconds.observe(time.perf_counter() - conn.info["query_started"].pop(), name)
+
+with app.app_context():
+    instrument_engine(db.engine, "write")
+instrument_engine(read_engine, "read")
+
+class CommandTrace:
+    """Optional JSON-lines timeline of every command (TRACE_LOG).
+
+    emit() only queues the record; a background thread does the writing, so
+    the dispatch path never waits on the disk.
+    """
+
+    def __init__(self, path=TRACE_LOG):
+        self.path = path
+        self.queue = queue.Queue(maxsize=10000)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def emit(self, cmd_id, kind, **fields):
+        if not self.path:
+            return
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="trace", daemon=True)
+                    self.thread.start()
         try:
-            cmd_id = command_queue.get(timeout=1)
-        except:
+            self.queue.put_nowait(dict(ts=round(time.time(), 3), cmd_id=cmd_id, event=kind, **fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        with open(self.path, "a") as f:
+            while True:
+                records = [self.queue.get()]
+                while not self.queue.empty() and len(records) < 500:
+                    records.append(self.queue.get_nowait())
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+                f.flush()
+
+trace = CommandTrace()
+
+
+# --- Dispatch Engine ---
+dispatch_pool = ThreadPoolExecutor(max_workers=DISPATCH_CONCURRENCY, thread_name_prefix="dispatch")
+dispatch_log = deque(maxlen=DISPATCH_LOG_SIZE)
+_http_local = threading.local()
+
+def get_http_session():
+    # One keep-alive session per dispatch thread; requests.Session isn't thread-safe
+    session = getattr(_http_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=256, pool_maxsize=4, max_retries=0)
+        session.mount("http://", adapter)
+        _http_local.session = session
+    return session
+
+def intercom_url(ip, **params):
+    return f"http://{ip}:{INTERCOM_HTTP_PORT}/?{urlencode(params)}"
+
+def send_to_intercom(intercom_id, name, url, timeout=DISPATCH_TIMEOUT, abort=None):
+    sent_at = time.time()
+    if abort is not None and abort():
+        return {"intercom_id": intercom_id, "name": name, "ok": False, "error": "cancelled",
+                "sent_at": sent_at, "finished_at": sent_at, "latency_ms": 0.0, "timed_out": False}
+    error = None
+    timed_out = False
+    try:
+        response = get_http_session().get(url, timeout=timeout)
+        if not response.ok:
+            error = f"HTTP {response.status_code}"
+    except requests.Timeout as e:
+        error = str(e)
+        timed_out = True
+    except Exception as e:
+        error = str(e)
+    finished_at = time.time()
+    return {
+        "intercom_id": intercom_id,
+        "name": name,
+        "ok": error is None,
+        "error": error,
+        "sent_at": sent_at,
+        "finished_at": finished_at,
+        "latency_ms": round((finished_at - sent_at) * 1000, 1),
+        "timed_out": timed_out,
+    }
+
+class LatencyModel:
+    """Rolling per-intercom round-trip history used to pick start_time leads."""
+
+    def __init__(self, history_size=LATENCY_HISTORY_SIZE):
+        self.lock = threading.Lock()
+        self.history = {}
+        self.history_size = history_size
+        self.steps = 0
+        self.late_steps = 0
+        self.deliveries = 0
+        self.late_deliveries = 0
+
+    def estimate_ms(self, intercom_id):
+        # 90th percentile of recent round trips; unknown devices are assumed slow
+        samples = self.history.get(intercom_id)
+        if not samples:
+            return DISPATCH_TIMEOUT * 1000
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))]
+
+    def lead_time_ms(self, intercom_ids):
+        if not intercom_ids:
+            return LEAD_TIME_MIN_MS
+        with self.lock:
+            estimates = sorted((self.estimate_ms(i) for i in intercom_ids), reverse=True)
+        # Requests go out in waves of DISPATCH_CONCURRENCY; the slowest device
+        # bounds the first wave and later waves cost about the mean round trip.
+        waves = math.ceil(len(estimates) / DISPATCH_CONCURRENCY)
+        fanout_ms = estimates[0] + (waves - 1) * (sum(estimates) / len(estimates))
+        lead_ms = LEAD_TIME_BASE_MS + fanout_ms * LEAD_TIME_MARGIN
+        return int(min(max(lead_ms, LEAD_TIME_MIN_MS), LEAD_TIME_MAX_MS))
+
+    def observe(self, intercom_id, latency_ms):
+        with self.lock:
+            self.history.setdefault(intercom_id, deque(maxlen=self.history_size)).append(latency_ms)
+
+    def record(self, results, start_time):
+        late = 0
+        with self.lock:
+            for r in results:
+                if r["error"] == "cancelled":
+                    continue  # never sent
+                # A timeout tells us the device is at least that slow; a quick
+                # refusal or HTTP error took only as long as it took
+                latency = DISPATCH_TIMEOUT * 1000 if r["timed_out"] else r["latency_ms"]
+                self.history.setdefault(r["intercom_id"], deque(maxlen=self.history_size)).append(latency)
+                if r["ok"] and r["finished_at"] > start_time:
+                    late += 1
+            self.steps += 1
+            self.deliveries += len(results)
+            self.late_deliveries += late
+            if late:
+                self.late_steps += 1
+        return late
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "steps": self.steps,
+                "late_steps": self.late_steps,
+                "deliveries": self.deliveries,
+                "late_deliveries": self.late_deliveries,
+                "intercoms": {
+                    intercom_id: {
+                        "samples": len(samples),
+                        "p90_ms": self.estimate_ms(intercom_id),
+                        "last_ms": samples[-1],
+                    }
+                    for intercom_id, samples in self.history.items()
+                },
+            }
+
+latency_model = LatencyModel()
+
+def next_start_time(intercom_ids):
+    """Millisecond-resolution start_time (epoch seconds) far enough out for this fan-out."""
+    lead_ms = latency_model.lead_time_ms(intercom_ids)
+    return round(time.time() + lead_ms / 1000.0, 3), lead_ms
+
+def dispatch_step(jobs, label="", start_time=None, lead_ms=None, cmd_id=None, timeout=DISPATCH_TIMEOUT, abort=None,
+                  kind="step"):
+    """Send one step to every target in parallel.
+
+    jobs is a list of (intercom_id, name, url) tuples. Blocks until every
+    request has completed or timed out and returns one result dict per job.
+    When start_time is given, deliveries that completed after it are counted
+    as late and fed back into the latency model. Requests that haven't gone
+    out yet when abort() turns true are dropped. kind labels the metrics
+    ("step", "preempt" or "stop").
+    """
+    started = time.time()
+    futures = [dispatch_pool.submit(send_to_intercom, *job, timeout=timeout, abort=abort) for job in jobs]
+    results = [f.result() for f in futures]
+    elapsed_ms = round((time.time() - started) * 1000, 1)
+
+    failed = [r for r in results if not r["ok"]]
+    late = latency_model.record(results, start_time) if start_time is not None else 0
+    request_seconds.observe_many([r["latency_ms"] / 1000 for r in results if r["ok"]], kind, "ok")
+    if failed:
+        request_seconds.observe_many([r["latency_ms"] / 1000 for r in failed], kind, "failed")
+    fanout_seconds.observe(elapsed_ms / 1000, kind)
+    if start_time is not None:
+        start_margin_seconds.observe_many([start_time - r["finished_at"] for r in results if r["ok"]])
+        if late:
+            late_deliveries.inc(late)
+    if VERBOSE_DISPATCH_LOG or failed or late:
+        names = ", ".join(r["name"] for r in failed[:5]) + (f" and {len(failed) - 5} more" if len(failed) > 5 else "")
+        print(f"Dispatched {label} to {len(results)} intercom(s) in {elapsed_ms} ms "
+              f"(lead {lead_ms} ms), {len(failed)} failed{f' ({names})' if failed else ''}, {late} late")
+    if cmd_id is not None:
+        trace.emit(cmd_id, kind, label=label, start_time=start_time, lead_ms=lead_ms, elapsed_ms=elapsed_ms,
+                   sent=len(results), failed=[r["name"] for r in failed], late=late)
+
+    dispatch_log.append({
+        "label": label,
+        "started_at": started,
+        "start_time": start_time,
+        "lead_ms": lead_ms,
+        "elapsed_ms": elapsed_ms,
+        "sent": len(results),
+        "failed": len(failed),
+        "late": late,
+        "results": results,
+    })
+    event_bus.publish("dispatch", {
+        "cmd_id": cmd_id,
+        "label": label,
+        "elapsed_ms": elapsed_ms,
+        "sent": len(results),
+        "failed": len(failed),
+        "late": late,
+    })
+    return results
+
+# --- Playback Plans ---
+PlanTarget = namedtuple("PlanTarget", "intercom_id name ip_address")
+PlanStep = namedtuple("PlanStep", "sound_id filename duration_ms volumes gap_ms")  # volumes line up with plan targets
+PlaybackPlan = namedtuple("PlaybackPlan", "version targets steps")
+
+def clamp_volume(volume):
+    return min(max(volume, 5), 100)
+
+def step_gap_ms(step, default):
+    return step.gap_ms if step.gap_ms is not None else default
+
+def plan_key(cmd):
+    return (cmd.intercom_id, cmd.intercom_group_id, cmd.announcement_id, cmd.sound_id, cmd.volume_modifier)
+
+def resolve_targets(intercom_id, intercom_group_id):
+    # Nested groups flattened, disabled intercoms dropped, each device once
+    return membership_index.targets(intercom_id, intercom_group_id)
+
+def compile_plan(key, version):
+    """Resolve targets, sounds and final volumes for a command. Needs an app context."""
+    intercom_id, intercom_group_id, announcement_id, sound_id, volume_modifier = key
+    targets = resolve_targets(intercom_id, intercom_group_id)
+
+    # (sound, item volume, gap after) per step
+    entries = []
+    announcement_volume = 0
+    if sound_id:
+        entries = [(Sound.query.get(sound_id), 0, None)]
+    elif announcement_id:
+        announcement = (Announcement.query.options(selectinload(Announcement.items).selectinload(AnnouncementItem.sound))
+                        .filter_by(id=announcement_id).first())
+        if announcement:
+            announcement_volume = announcement.volume_modifier
+            entries = [(item.sound, item.volume_modifier or 0, item.gap_ms) for item in announcement.items]
+
+    steps = []
+    for sound, item_volume, gap_ms in entries:
+        if sound is None:
+            print(f"Skipping missing sound in plan {key}")
             continue
+        gain = sound.loudness_gain or 1.0
+        volumes = tuple(clamp_volume(round((volume_modifier + intercom.volume_modifier + announcement_volume
+                                            + item_volume + sound.volume_modifier) * gain))
+                        for intercom in targets)
+        steps.append(PlanStep(sound.id, sound.filename, sound.play_duration_ms, volumes, gap_ms))
+
+    return PlaybackPlan(
+        version,
+        tuple(PlanTarget(intercom.id, intercom.name, intercom.ip_address) for intercom in targets),
+        tuple(steps),
+    )
+
+class PlanCache:
+    """Compiled playback plans, dropped wholesale whenever the catalog changes.
+
+    Routes that edit or delete intercoms, groups, sounds or announcements call
+    invalidate(); plans compiled against an older version are recompiled the
+    next time they are asked for.
+    """
+
+    def __init__(self, max_size=1024):
+        self.lock = threading.Lock()
+        self.plans = {}
+        self.version = 0
+        self.max_size = max_size
+
+    def invalidate(self, broadcast=True):
+        with self.lock:
+            self.version += 1
+            self.plans.clear()
+        # Let the dispatcher node know when the edit came in through another one
+        if broadcast and has_app_context():
+            cluster.bump_catalog()
+
+    def get(self, key):
+        with self.lock:
+            plan = self.plans.get(key)
+            version = self.version
+        if plan is not None and plan.version == version:
+            return plan
+        # Compile outside the lock; if the catalog changes meanwhile the plan
+        # carries the old version and is simply recompiled next time
+        plan = compile_plan(key, version)
+        with self.lock:
+            if plan.version == self.version:
+                if len(self.plans) >= self.max_size:
+                    self.plans.clear()
+                self.plans[key] = plan
+        return plan
+
+plan_cache = PlanCache()
+
+# --- Command Queue Store ---
+def summarize_ms(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50_ms": values[len(values) // 2],
+        "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max_ms": values[-1],
+    }
+
+class CommandStore:
+    """Keeps AnnouncementCommand rows in step with the scheduler.
+
+    State changes are buffered and written by one thread every
+    QUEUE_FLUSH_INTERVAL, which also renews this node's leases, recovers
+    commands whose lease lapsed (resuming them at the repetition and step
+    they had reached) and purges old done rows.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirty = {}
+        self.queue_waits = deque(maxlen=QUEUE_WAIT_HISTORY_SIZE)
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="command-store", daemon=True)
+        self.thread.start()
+
+    def mark(self, playback, state):
+        with self.lock:
+            self.dirty[playback.cmd_id] = (playback, state)
+
+    def record_wait(self, seconds):
+        queue_wait_seconds.observe(seconds)
+        with self.lock:
+            self.queue_waits.append(round(seconds * 1000, 1))
+
+    def submit(self, cmd, triggered_at=None):
+        """Start a newly queued command here if this node dispatches; otherwise the dispatcher picks it up."""
+        if cluster.is_leader:
+            if self.claim(cmd.id):
+                scheduler.submit(cmd, triggered_at=triggered_at)
+        else:
+            dispatch_notifier.send("queue", cmd_id=cmd.id)
+
+    def submit_many(self, cmds, triggered_at=None, claimed=False):
+        """Start a batch written by queue_commands(); claimed rows were inserted already leased to this node."""
+        if claimed and cluster.is_leader:
+            for cmd in cmds:
+                scheduler.submit(cmd, triggered_at=triggered_at)
+        elif cluster.is_leader:
+            for cmd in cmds:
+                self.submit(cmd, triggered_at=triggered_at)
+        else:
+            dispatch_notifier.send("queue", cmd_ids=[cmd.id for cmd in cmds])
+
+    def claim(self, cmd_id):
+        # Conditional update, so only one node wins an unleased or lapsed row
+        now = time.time()
+        claimed = AnnouncementCommand.query.filter(
+            AnnouncementCommand.id == cmd_id,
+            db.or_(AnnouncementCommand.lease_expires < now, AnnouncementCommand.lease_expires.is_(None)),
+        ).update({"lease_owner": NODE_ID, "lease_expires": now + QUEUE_LEASE_SECONDS})
+        db.session.commit()
+        return bool(claimed)
 
+    def finish(self, playback):
+        with self.lock:
+            self.dirty.pop(playback.cmd_id, None)
         with app.app_context():
-            cmd = db.session.query(AnnouncementCommand).get(cmd_id)
-            if cmd is None:
+            AnnouncementCommand.query.filter_by(id=playback.cmd_id).update(
+                {"state": "done", "finished_at": time.time(), "repetition": playback.repetition})
+            db.session.commit()
+
+    def _run(self):
+        while not stop_event.is_set():
+            try:
+                with app.app_context():
+                    cluster.elect()
+                    # Standbys follow the catalog too, so one that takes over doesn't start on stale groups
+                    cluster.sync_catalog()
+                    if cluster.is_leader:
+                        self.flush()
+                        self.renew()
+                        self.reconcile()
+                        self.recover()
+                        self.purge()
+            except Exception as e:
+                print(f"Command store error: {e}")
+                db.session.remove()
+                cluster.fence()
+            self.wake.wait(QUEUE_FLUSH_INTERVAL)
+            self.wake.clear()
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        for cmd_id, (playback, state) in dirty.items():
+            values = {"state": state, "repetition": playback.repetition, "step_index": playback.step_index}
+            if state == "done":
+                values["finished_at"] = time.time()  # a finish() that failed
+            AnnouncementCommand.query.filter(AnnouncementCommand.id == cmd_id, AnnouncementCommand.state != "done").update(
+                values)
+        db.session.commit()
+
+    def renew(self):
+        now = time.time()
+        AnnouncementCommand.query.filter(
+            AnnouncementCommand.lease_owner == NODE_ID,
+            AnnouncementCommand.state != "done",
+            AnnouncementCommand.lease_expires < now + QUEUE_LEASE_SECONDS / 2,
+        ).update({"lease_expires": now + QUEUE_LEASE_SECONDS})
+        db.session.commit()
+
+    def reconcile(self):
+        # Drop playbacks whose rows were deleted or cleared through another node
+        tracked = scheduler.tracked_ids()
+        if not tracked:
+            return
+        existing = {cmd_id for (cmd_id,) in db.session.query(AnnouncementCommand.id)
+                    .filter(AnnouncementCommand.id.in_(tracked))}
+        if tracked - existing:
+            scheduler.cancel_many(sorted(tracked - existing))
+
+    def recover(self):
+        # New commands queued on other nodes, and commands whose lease lapsed
+        now = time.time()
+        lapsed = db.or_(AnnouncementCommand.lease_expires < now, AnnouncementCommand.lease_expires.is_(None))
+        for cmd in AnnouncementCommand.query.filter(AnnouncementCommand.state != "done", lapsed).all():
+            previous_owner = cmd.lease_owner
+            if scheduler.tracks(cmd.id):
+                continue  # ours already; renew() will catch up
+            if self.claim(cmd.id):
+                if previous_owner:
+                    print(f"Recovering command ID {cmd.id} from {previous_owner} "
+                          f"at repetition {cmd.repetition or 0}, step {cmd.step_index or 0}")
+                scheduler.submit(cmd, triggered_at=cmd.queued_at)
+
+    def release(self):
+        # Draining: unlease our commands so the next dispatcher resumes them right away
+        AnnouncementCommand.query.filter(
+            AnnouncementCommand.lease_owner == NODE_ID,
+            AnnouncementCommand.state != "done",
+        ).update({"lease_expires": None})
+        db.session.commit()
+
+    def purge(self):
+        AnnouncementCommand.query.filter(
+            AnnouncementCommand.state == "done",
+            AnnouncementCommand.finished_at < time.time() - QUEUE_DONE_RETENTION,
+        ).delete()
+        TriggerRequest.query.filter(TriggerRequest.created_at < time.time() - IDEMPOTENCY_KEY_TTL).delete()
+        db.session.commit()
+
+    def stats(self):
+        with self.lock:
+            waits = list(self.queue_waits)
+        counts = dict(read_session.query(AnnouncementCommand.state, db.func.count(AnnouncementCommand.id))
+                      .group_by(AnnouncementCommand.state).all())
+        snapshot = scheduler.snapshot()
+        return {
+            "node": NODE_ID,
+            "dispatcher": cluster.is_leader,
+            "depth": {"pending": len(snapshot["pending"]), "active": len(snapshot["active"])},
+            "by_state": counts,
+            "time_in_queue": summarize_ms(waits),
+        }
+
+command_store = CommandStore()
+
+class Cluster:
+    """Leader election between server processes sharing the database.
+
+    The node holding the "dispatcher" lease runs the scheduler, so an
+    intercom is never driven by two nodes. The lease is taken and renewed
+    with conditional UPDATEs. A leader that can't renew in time stands down
+    on its own (before the lease lapses for the others), and a standby takes
+    over and recovers the commands once it does.
+    """
+
+    def __init__(self):
+        self.leader_until = 0
+        self.leading = False
+        self.catalog_version = None
+
+    @property
+    def is_leader(self):
+        return self.leading and time.time() < self.leader_until
+
+    def elect(self):
+        if not DISPATCHER_ENABLED:
+            return
+        now = time.time()
+        won = ClusterState.query.filter(
+            ClusterState.name == "dispatcher",
+            db.or_(ClusterState.holder == NODE_ID, ClusterState.expires < now),
+        ).update({"holder": NODE_ID, "expires": now + LEADER_LEASE_SECONDS, "address": dispatch_notifier.address,
+                  "http_address": dispatch_notifier.http_address})
+        db.session.commit()
+        if not won and ClusterState.query.get("dispatcher") is None:
+            try:
+                db.session.add(ClusterState(name="dispatcher", holder=NODE_ID, expires=now + LEADER_LEASE_SECONDS,
+                                            address=dispatch_notifier.address,
+                                            http_address=dispatch_notifier.http_address))
+                db.session.commit()
+                won = True
+            except exc.IntegrityError:
+                db.session.rollback()
+        if won:
+            # Stand down a little before the others may take over
+            self.leader_until = now + LEADER_LEASE_SECONDS * 0.8
+            if not self.leading:
+                self.leading = True
+                print(f"{NODE_ID} is now the dispatcher")
+                event_bus.publish("cluster", {"dispatcher": NODE_ID})
+                health_monitor.refresh()
+        else:
+            self.fence(force=True)
+
+    def fence(self, force=False):
+        # Stop driving intercoms once the lease can't be vouched for
+        if self.leading and (force or time.time() >= self.leader_until):
+            self.leading = False
+            self.leader_until = 0
+            print(f"{NODE_ID} lost the dispatcher lease, standing down")
+            scheduler.cancel_all(notify=False)
+
+    def resign(self):
+        # Draining: let a standby take over without waiting for the lease to lapse
+        self.leading = False
+        self.leader_until = 0
+        ClusterState.query.filter_by(name="dispatcher", holder=NODE_ID).update({"expires": 0})
+        db.session.commit()
+
+    def bump_catalog(self):
+        if not ClusterState.query.filter_by(name="catalog").update({"version": ClusterState.version + 1}):
+            db.session.add(ClusterState(name="catalog", version=1))
+        db.session.commit()
+
+    def sync_catalog(self):
+        # Drop what this process cached for an older catalog. The first call drops
+        # it too: anything loaded before it may predate edits made elsewhere.
+        row = ClusterState.query.get("catalog")
+        version = row.version if row else 0
+        if version != self.catalog_version:
+            plan_cache.invalidate(broadcast=False)
+            membership_index.invalidate()
+            if schedule_engine.thread:
+                schedule_engine.reload()
+        self.catalog_version = version
+
+    def snapshot(self):
+        row = ClusterState.query.get("dispatcher")
+        return {
+            "node": NODE_ID,
+            "dispatcher": row.holder if row and row.expires and row.expires > time.time() else None,
+            "is_dispatcher": self.is_leader,
+            "dispatcher_enabled": DISPATCHER_ENABLED,
+        }
+
+cluster = Cluster()
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+class DispatchNotifier:
+    """UDP nudges from web workers to the dispatcher, and its internal HTTP port.
+
+    The dispatcher listens on ephemeral ports and publishes them with its
+    lease. Datagrams are hints: a lost one only means the command waits for
+    the dispatcher's next QUEUE_FLUSH_INTERVAL poll. The HTTP port serves the
+    routes marked @dispatcher_state, which workers relay to it.
+    """
+
+    def __init__(self):
+        self.address = None
+        self.http_address = None
+        self.sock = None
+        self.target = None
+        self.http_target = None
+        self.looked_up_at = 0
+        self.lock = threading.Lock()
+
+    def listen(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((DISPATCH_NOTIFY_HOST, 0))
+        self.sock.settimeout(1)
+        self.address = "%s:%d" % self.sock.getsockname()
+        threading.Thread(target=self._run, name="dispatch-notify", daemon=True).start()
+        server = make_server(DISPATCH_NOTIFY_HOST, 0, app, threaded=True, request_handler=QuietRequestHandler)
+        self.http_address = "%s:%d" % server.server_address[:2]
+        threading.Thread(target=server.serve_forever, name="dispatch-http", daemon=True).start()
+
+    def _lookup(self):
+        with self.lock:
+            if time.time() - self.looked_up_at > LEADER_LEASE_SECONDS:
+                with read_engine.connect() as conn:
+                    row = conn.execute(db.select(ClusterState.address, ClusterState.http_address, ClusterState.expires)
+                                       .where(ClusterState.name == "dispatcher")).first()
+                live = row is not None and row.expires and row.expires > time.time()
+                self.target = None
+                if live and row.address:
+                    host, _, port = row.address.rpartition(":")
+                    self.target = (host, int(port))
+                self.http_target = row.http_address if live else None
+                self.looked_up_at = time.time()
+
+    def _dispatcher_address(self):
+        self._lookup()
+        return self.target
+
+    def dispatcher_http_address(self):
+        self._lookup()
+        return self.http_target
+
+    def send(self, kind, **data):
+        try:
+            target = self._dispatcher_address()
+            if target:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.sendto(json.dumps(dict(data, kind=kind)).encode(), target)
+        except Exception as e:
+            print(f"Couldn't notify the dispatcher: {e}")
+
+    def request(self, kind, timeout, **data):
+        """Like send(), but wait for the dispatcher to answer. False if none did."""
+        try:
+            target = self._dispatcher_address()
+            if not target:
+                return False
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(timeout)
+                sock.sendto(json.dumps(dict(data, kind=kind)).encode(), target)
+                sock.recvfrom(65536)
+            return True
+        except Exception as e:
+            print(f"No answer from the dispatcher: {e}")
+            return False
+
+    def _run(self):
+        while not stop_event.is_set():
+            try:
+                data, sender = self.sock.recvfrom(65536)
+                message = json.loads(data)
+            except socket.timeout:
+                continue
+            except ValueError:
                 continue
+            kind = message.get("kind")
+            if kind == "queue":
+                command_store.wake.set()
+            elif kind in ("sync", "forget"):
+                sound_sync.handle_remote(message)
+            elif kind == "stop":
+                threading.Thread(target=self._stop, args=(sender,), name="dispatch-stop", daemon=True).start()
+
+    def _stop(self, sender):
+        # The queue was cleared on another process: drop those commands now
+        # instead of at the next poll, and answer once in-flight steps are done
+        try:
+            with app.app_context():
+                command_store.reconcile()
+            event_bus.publish("queue_cleared", {})
+            scheduler.wait_idle(DISPATCH_TIMEOUT)
+        finally:
+            self.sock.sendto(json.dumps({"kind": "stopped"}).encode(), sender)
+
+dispatch_notifier = DispatchNotifier()
+
+def dispatcher_state(view):
+    """For routes that read or act on the dispatcher's in-memory state.
+
+    Any other process relays the request to the dispatcher's HTTP address and
+    streams its answer back, or serves its own (empty) view if the dispatcher
+    can't be reached.
+    """
+    @functools.wraps(view)
+    def relay(*args, **kwargs):
+        if cluster.is_leader or request.headers.get("X-Intercom-Relayed"):
+            return view(*args, **kwargs)
+        address = dispatch_notifier.dispatcher_http_address()
+        if not address:
+            return view(*args, **kwargs)
+        headers = {name: request.headers[name] for name in ("Accept", "Cookie") if name in request.headers}
+        headers["X-Intercom-Relayed"] = "1"
+        try:
+            upstream = requests.get(f"http://{address}{request.full_path}", headers=headers, stream=True,
+                                    allow_redirects=False, timeout=(1, RELAY_TIMEOUT))
+        except requests.RequestException as e:
+            print(f"Couldn't relay {request.path} to the dispatcher: {e}")
+            return view(*args, **kwargs)
 
-            print(f"Processing command ID {cmd.id}...")
-            targets = []
-
-            if cmd.intercom_id:
-                intercom = Intercom.query.get(cmd.intercom_id)
-                if intercom:
-                    targets.append(intercom)
-
-            elif cmd.intercom_group_id:
-                group = IntercomGroup.query.get(cmd.intercom_group_id)
-                if group:
-                    targets.extend(group.intercoms)
-
-            if cmd.sound_id:
-                sound = Sound.query.get(cmd.sound_id)
-                for i in range(cmd.times_to_play):
-                    start_time = int(time.time()) + 5
-                    for intercom in targets:
-                        if intercom.disabled:
-                            continue
-
-                        url = f"http://{intercom.ip_address}:8084/?type=sound&message={sound.filename}&times=1&volume={min(max(cmd.volume_modifier + intercom.volume_modifier + sound.volume_modifier, 5), 100)}&priority=100&id={cmd.id}&start_time={start_time}"
-                        print(f"GET {url}")
+        def body():
+            try:
+                yield from upstream.iter_content(chunk_size=None)
+            finally:
+                upstream.close()
+
+        response = Response(stream_with_context(body()), status=upstream.status_code)
+        for name in ("Content-Type", "Cache-Control", "X-Accel-Buffering", "Location"):
+            if name in upstream.headers:
+                response.headers[name] = upstream.headers[name]
+        for cookie in upstream.raw.headers.getlist("Set-Cookie"):
+            response.headers.add("Set-Cookie", cookie)
+        return response
+    return relay
+
+
+# --- Scheduler ---
+class Playback:
+    """Progress of one active AnnouncementCommand."""
+
+    def __init__(self, cmd_id, key, plan, times_to_play=1, loop_forever=False, priority=DEFAULT_PRIORITY, triggered_at=None):
+        self.cmd_id = cmd_id
+        self.key = key
+        self.plan = plan
+        self.times_to_play = times_to_play or 1
+        self.loop_forever = loop_forever
+        self.all_target_ids = frozenset(target.intercom_id for target in plan.targets)
+        self.target_ids = self.all_target_ids
+        self.priority = priority
+        self.triggered_at = triggered_at or time.time()
+        self.seq = 0
+        self.epoch = 0
+        self.repetition = 0
+        self.step_index = 0
+        self.next_start = None
+        self.preempt_ids = frozenset()
+        self.first_audio_at = None
+        self.enqueued_at = None
+        self.cancelled = False
+
+    @property
+    def sort_key(self):
+        return (-self.priority, self.seq)
+
+class Scheduler:
+    """Plays queued commands concurrently, one lane per set of target intercoms.
+
+    Commands whose targets don't overlap play at the same time. Overlapping
+    ones wait in priority then queue order, and a higher-priority command
+    preempts lower-priority playback on the intercoms it shares with it. Each
+    intercom has its own wait heap, and only commands that reached the front
+    of one are reconsidered when something changes, so queueing, finishing
+    and cancelling cost O(log n) in the number of waiting commands. Waits
+    between sounds are timers on a single heap rather than sleeping threads,
+    and steps run on a small worker pool, so the thread count doesn't grow
+    with the number of active commands.
+    """
+
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.cond = threading.Condition()
+        self.timers = []
+        self.counter = itertools.count()
+        self.pending_by_id = {}
+        self.waiting = {}
+        self.candidates = []
+        self.active = {}
+        self.busy = {}
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scheduler")
+        self.thread = None
+        self.trigger_latency = deque(maxlen=TRIGGER_LATENCY_HISTORY_SIZE)
+        self.stepping = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="scheduler-timer", daemon=True)
+        self.thread.start()
+
+    def join(self, timeout=None):
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(timeout)
+        self.workers.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, cmd, triggered_at=None):
+        """Queue an AnnouncementCommand. Must be called inside an app context."""
+        key = plan_key(cmd)
+        playback = Playback(cmd.id, key, plan_cache.get(key), times_to_play=cmd.times_to_play,
+                            loop_forever=cmd.loop_forever,
+                            priority=cmd.priority if cmd.priority is not None else DEFAULT_PRIORITY,
+                            triggered_at=triggered_at)
+        # Recovered commands pick up where they left off
+        playback.repetition = cmd.repetition or 0
+        playback.step_index = cmd.step_index or 0
+        if cmd.start_at and cmd.start_at > time.time():
+            playback.next_start = cmd.start_at  # scheduled: the first step starts exactly then
+        if cmd.state not in (None, "pending"):
+            playback.first_audio_at = playback.triggered_at  # already played; not a trigger latency sample
+        event_bus.publish("command", dict(command_row(cmd), state="waiting"))
+        trace.emit(cmd.id, "triggered", priority=playback.priority, targets=len(playback.plan.targets),
+                   steps=len(playback.plan.steps), repetition=playback.repetition, step_index=playback.step_index)
+        with self.cond:
+            playback.seq = next(self.counter)
+            self._enqueue(playback)
+            self._admit()
+
+    def cancel(self, cmd_id):
+        self.cancel_many([cmd_id])
+
+    def cancel_many(self, cmd_ids):
+        # Under one lock, so none of them is admitted while the others are cancelled
+        with self.cond:
+            for cmd_id in cmd_ids:
+                if cmd_id in self.pending_by_id:
+                    waiting = self.pending_by_id[cmd_id]
+                    self._unpend(waiting)
+                    self._wake(waiting.target_ids)
+                playback = self.active.get(cmd_id)
+                if playback:
+                    playback.cancelled = True
+                    self._release(playback)
+            self._admit()
+        for cmd_id in cmd_ids:
+            trace.emit(cmd_id, "cancelled")
+            event_bus.publish("command", {"id": cmd_id, "state": "removed"})
+
+    def cancel_all(self, notify=True):
+        with self.cond:
+            self.pending_by_id = {}
+            self.waiting = {}
+            self.candidates = []
+            for playback in self.active.values():
+                playback.cancelled = True
+            self.active.clear()
+            self.busy.clear()
+            self.timers = [t for t in self.timers if not (t[3] and getattr(t[3][0], "cancelled", False))]
+            heapq.heapify(self.timers)
+        if notify:
+            event_bus.publish("queue_cleared", {})
+
+    def tracks(self, cmd_id):
+        with self.cond:
+            return cmd_id in self.active or cmd_id in self.pending_by_id
+
+    def tracked_ids(self):
+        with self.cond:
+            return set(self.active) | set(self.pending_by_id)
+
+    def wait_idle(self, timeout):
+        """Wait for steps already being dispatched to finish (after cancel_all)."""
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.stepping and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return self.stepping == 0
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                "active": sorted(self.active),
+                "pending": [p.cmd_id for p in sorted(self.pending_by_id.values(), key=lambda p: p.sort_key)],
+                "busy_intercoms": len(self.busy),
+                "timers": len(self.timers),
+            }
+
+    def trigger_latency_stats(self):
+        with self.cond:
+            samples = list(self.trigger_latency)
+        return {
+            "emergency": summarize_ms([sample["trigger_to_audio_ms"] for sample in samples
+                                       if sample["priority"] >= EMERGENCY_PRIORITY]),
+            "all": summarize_ms([sample["trigger_to_audio_ms"] for sample in samples]),
+            "recent": samples[-20:],
+        }
+
+    def call_at(self, due, fn, *args):
+        with self.cond:
+            heapq.heappush(self.timers, (due, next(self.counter), fn, args))
+            self.cond.notify()
+
+    def _spawn(self, fn, *args):
+        self.workers.submit(self._guarded, fn, *args)
+
+    @staticmethod
+    def _guarded(fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Scheduler task {fn.__name__} failed: {e}")
+
+    def _run(self):
+        while not stop_event.is_set():
+            with self.cond:
+                now = time.time()
+                if not self.timers or self.timers[0][0] > now:
+                    timeout = self.timers[0][0] - now if self.timers else 1
+                    self.cond.wait(min(timeout, 1))
+                    continue
+                _, _, fn, args = heapq.heappop(self.timers)
+            self._spawn(fn, *args)
+
+    def _enqueue(self, playback):
+        # Caller holds self.cond; joins the wait heap of each of its intercoms
+        entry = (playback.sort_key, playback.cmd_id)
+        for intercom_id in playback.target_ids:
+            heapq.heappush(self.waiting.setdefault(intercom_id, []), entry)
+        heapq.heappush(self.candidates, entry)
+        self.pending_by_id[playback.cmd_id] = playback
+        playback.enqueued_at = time.time()
+        command_store.mark(playback, "pending")
+        event_bus.publish("command", {"id": playback.cmd_id, "state": "waiting"})
+
+    def _unpend(self, playback):
+        # Caller holds self.cond; its heap entries are dropped lazily by _head
+        del self.pending_by_id[playback.cmd_id]
+
+    def _head(self, intercom_id):
+        # Caller holds self.cond. The first command waiting for an intercom,
+        # discarding entries of commands admitted, cancelled or requeued since
+        heap = self.waiting.get(intercom_id)
+        while heap:
+            key, cmd_id = heap[0]
+            playback = self.pending_by_id.get(cmd_id)
+            if playback and playback.sort_key == key and intercom_id in playback.target_ids:
+                return playback
+            heapq.heappop(heap)
+        self.waiting.pop(intercom_id, None)
+        return None
+
+    def _wake(self, intercom_ids):
+        # Caller holds self.cond; whoever is next on these intercoms gets another look
+        for intercom_id in intercom_ids:
+            playback = self._head(intercom_id)
+            if playback:
+                heapq.heappush(self.candidates, (playback.sort_key, playback.cmd_id))
+
+    def _admit(self):
+        # Caller holds self.cond. Candidates are tried best first; one goes
+        # ahead only from the front of every intercom it waits for, so
+        # overlapping commands keep their order.
+        while self.candidates:
+            key, cmd_id = heapq.heappop(self.candidates)
+            playback = self.pending_by_id.get(cmd_id)
+            if not playback or playback.sort_key != key:
+                continue
+            if any(self._head(intercom_id) is not playback for intercom_id in playback.target_ids):
+                continue  # woken again when it reaches the front
+            holders = [self.active[holder_id] for holder_id in {self.busy[i] for i in playback.target_ids if i in self.busy}]
+            if any(holder.priority >= playback.priority for holder in holders):
+                continue  # woken again when the intercoms are released
+
+            preempted = set()
+            for holder in holders:
+                preempted |= self._preempt(holder, playback.target_ids)
+            playback.preempt_ids = frozenset(preempted)
+
+            self._unpend(playback)
+            command_store.mark(playback, "dispatching")
+            command_store.record_wait(time.time() - playback.enqueued_at)
+            trace.emit(playback.cmd_id, "admitted", wait_ms=round((time.time() - playback.enqueued_at) * 1000, 1),
+                       preempting=len(preempted))
+            self.active[playback.cmd_id] = playback
+            for intercom_id in playback.target_ids:
+                self.busy[intercom_id] = playback.cmd_id
+            due = time.time()
+            if playback.next_start:
+                # A little early, so now + lead hasn't already crept past the scheduled start
+                lead = latency_model.lead_time_ms(playback.target_ids) / 1000.0
+                due = max(due, playback.next_start - lead - SCHEDULE_ADMIT_MARGIN)
+            heapq.heappush(self.timers, (due, next(self.counter), self._step, (playback, playback.epoch)))
+            self.cond.notify()
+            event_bus.publish("command", {"id": playback.cmd_id, "state": "playing"})
+
+    def _preempt(self, holder, intercom_ids):
+        # Caller holds self.cond. Take the shared intercoms away from a
+        # lower-priority playback; it carries on with whatever it has left,
+        # or goes back to waiting (at its current step) if nothing is left.
+        # One whose last step already went out is finished instead.
+        taken = holder.target_ids & intercom_ids
+        for intercom_id in taken:
+            del self.busy[intercom_id]
+        holder.target_ids = holder.target_ids - taken
+        print(f"Command ID {holder.cmd_id} preempted on {len(taken)} intercom(s)")
+        trace.emit(holder.cmd_id, "preempted", intercoms=len(taken))
+        if not holder.target_ids:
+            self.active.pop(holder.cmd_id, None)
+            holder.epoch += 1
+            holder.target_ids = holder.all_target_ids
+            holder.next_start = None
+            if holder.repetition >= holder.times_to_play and not holder.loop_forever:
+                heapq.heappush(self.timers, (time.time(), next(self.counter), self._finish, (holder, holder.epoch)))
+            else:
+                self._enqueue(holder)
+        return taken
+
+    def _release(self, playback):
+        # Caller holds self.cond
+        self.active.pop(playback.cmd_id, None)
+        for intercom_id in playback.target_ids:
+            if self.busy.get(intercom_id) == playback.cmd_id:
+                del self.busy[intercom_id]
+        self._wake(playback.target_ids)
+
+    def _plan(self, playback):
+        # Only touches the database when the catalog changed since the last compile
+        if playback.plan.version != plan_cache.version:
+            with app.app_context():
+                playback.plan = plan_cache.get(playback.key)
+        return playback.plan
+
+    def _step(self, playback, epoch):
+        if playback.cancelled or playback.epoch != epoch:
+            return
+        if not cluster.is_leader:
+            return  # lease lapsed; the command store stands this node down
+        with self.cond:
+            self.stepping += 1
+        try:
+            self._run_step(playback, epoch)
+        finally:
+            with self.cond:
+                self.stepping -= 1
+                self.cond.notify_all()
+
+    def _run_step(self, playback, epoch):
+        plan = self._plan(playback)
+        if not plan.steps:
+            print(f"Command ID {playback.cmd_id} has nothing to play")
+            self._finish(playback, epoch)
+            return
+        if playback.step_index >= len(plan.steps):
+            playback.step_index = 0
+        if playback.repetition == 0 and playback.step_index == 0:
+            print(f"Processing command ID {playback.cmd_id}...")
+
+        # In playlist mode the rest of the repetition goes out as one request per intercom
+        if ANNOUNCEMENT_DISPATCH_MODE == "playlist":
+            items = plan.steps[playback.step_index:]
+        else:
+            items = plan.steps[playback.step_index:playback.step_index + 1]
+        targets = [(index, target) for index, target in enumerate(plan.targets)
+                   if target.intercom_id in playback.target_ids]
+        down = [target for _, target in targets if health_monitor.is_down(target.intercom_id)]
+        if down:
+            print(f"Command ID {playback.cmd_id}: skipping {len(down)} intercom(s) known to be down")
+            targets = [(index, target) for index, target in targets if target not in down]
+
+        # Rendered mode falls back to the item-by-item modes until every target has the render
+        rendered = None
+        if ANNOUNCEMENT_DISPATCH_MODE == "rendered" and playback.step_index == 0 and len(plan.steps) > 1:
+            rendered = render_cache.for_targets(playback.key[2], plan, targets)
+            if rendered:
+                items = plan.steps
+
+        if MISSING_SOUND_POLICY != "ignore" and not rendered:
+            sound_names = {f"{item.filename}.wav" for item in items}
+            missing = [target for _, target in targets
+                       if any(sound_sync.has_sound(target.intercom_id, name) is False for name in sound_names)]
+            if missing:
+                print(f"Command ID {playback.cmd_id}: {', '.join(sorted(sound_names))} not all synced to "
+                      f"{', '.join(target.name for target in missing)}")
+                sound_sync.push(sound_names, missing)
+                if MISSING_SOUND_POLICY == "skip":
+                    targets = [(index, target) for index, target in targets if target not in missing]
+        target_ids = [target.intercom_id for _, target in targets]
+
+        if playback.preempt_ids:
+            stop_jobs = [(target.intercom_id, target.name, intercom_url(target.ip_address, type="cmd", cmd="stopall"))
+                         for _, target in targets if target.intercom_id in playback.preempt_ids]
+            playback.preempt_ids = frozenset()
+            dispatch_step(stop_jobs, label=f"preempt for command {playback.cmd_id}", cmd_id=playback.cmd_id,
+                          abort=lambda: playback.cancelled, kind="preempt")
+
+        start_time, lead_ms = next_start_time(target_ids)
+        if playback.next_start and playback.next_start > start_time:
+            start_time = round(playback.next_start, 3)
+
+        offsets = []
+        offset_ms = 0
+        for item in items:
+            offsets.append(offset_ms)
+            offset_ms += item.duration_ms + step_gap_ms(item, ANNOUNCEMENT_GAP_MS)
+
+        jobs = []
+        for index, target in targets:
+            if rendered:
+                render, volume = rendered[index]
+                url = intercom_url(target.ip_address, type="sound", message=render.name, times=1,
+                                   volume=volume, priority=playback.priority, id=playback.cmd_id,
+                                   start_time=start_time)
+            elif len(items) == 1:
+                url = intercom_url(target.ip_address, type="sound", message=items[0].filename, times=1,
+                                   volume=items[0].volumes[index], priority=playback.priority, id=playback.cmd_id,
+                                   start_time=start_time)
+            else:
+                url = intercom_url(target.ip_address, type="playlist",
+                                   messages=",".join(item.filename for item in items),
+                                   offsets=",".join(map(str, offsets)),
+                                   volumes=",".join(str(item.volumes[index]) for item in items),
+                                   priority=playback.priority, id=playback.cmd_id, start_time=start_time)
+            jobs.append((target.intercom_id, target.name, url))
+        if playback.cancelled:
+            return
+        label = items[0].filename if len(items) == 1 else f"{'render' if rendered else 'playlist'} of {len(items)}"
+        dispatch_step(jobs, label=f"command {playback.cmd_id} sound {label}", start_time=start_time,
+                      lead_ms=lead_ms, cmd_id=playback.cmd_id, abort=lambda: playback.cancelled)
+
+        # Progress is updated under the lock so a preemption can't land halfway through it
+        with self.cond:
+            if playback.cancelled or playback.epoch != epoch:
+                return  # preempted while the step went out: it waits again and resumes at this step
+
+            if playback.first_audio_at is None:
+                playback.first_audio_at = start_time
+                self.trigger_latency.append({
+                    "cmd_id": playback.cmd_id,
+                    "priority": playback.priority,
+                    "trigger_to_audio_ms": round((start_time - playback.triggered_at) * 1000, 1),
+                })
+
+            ends_at = start_time + (offsets[-1] + items[-1].duration_ms) / 1000.0
+            gap_ms = step_gap_ms(items[-1], STEP_GAP_MS)
+            playback.step_index += len(items)
+            command_store.mark(playback, "playing")  # progress is read when the store flushes
+            if playback.step_index >= len(plan.steps):
+                playback.step_index = 0
+                playback.repetition += 1
+                gap_ms += REPEAT_GAP_MS
+                if playback.repetition >= playback.times_to_play:
+                    if not playback.loop_forever:
+                        self.call_at(ends_at + STEP_GAP_MS / 1000.0, self._finish, playback, epoch)
+                        return
+                    playback.repetition = 0
+                    playback.next_start = ends_at + gap_ms / 1000.0
+                    self.call_at(playback.next_start - lead_ms / 1000.0, self._requeue, playback, epoch)
+                    return
+
+            playback.next_start = next_start = ends_at + gap_ms / 1000.0
+        due = next_start - latency_model.lead_time_ms(target_ids) / 1000.0
+        self.call_at(due, self._step, playback, epoch)
+
+    def _requeue(self, playback, epoch):
+        # End of a loop cycle: give way to commands waiting on the same
+        # intercoms, pick up group changes, and try to win back intercoms
+        # lost to preemption
+        plan = self._plan(playback)
+        with self.cond:
+            if playback.cancelled or playback.epoch != epoch:
+                return
+            plan_target_ids = frozenset(target.intercom_id for target in plan.targets)
+            if plan_target_ids != playback.all_target_ids:
+                playback.all_target_ids = plan_target_ids
+            if (playback.target_ids != playback.all_target_ids
+                    or any(self._head(intercom_id) for intercom_id in playback.target_ids)):
+                self._release(playback)
+                playback.epoch += 1
+                playback.seq = next(self.counter)  # back of its priority class
+                playback.target_ids = playback.all_target_ids
+                playback.next_start = None
+                self._enqueue(playback)
+                self._admit()
+                return
+        self._step(playback, epoch)
+
+    def _finish(self, playback, epoch):
+        if playback.cancelled or playback.epoch != epoch:
+            return  # cancelled, or preempted since this timer was set
+        try:
+            command_store.finish(playback)
+        except Exception as e:
+            print(f"Couldn't mark command ID {playback.cmd_id} done, leaving it to the next flush: {e}")
+            command_store.mark(playback, "done")
+        finally:
+            # Whatever happened to the write, the intercoms are free again
+            with self.cond:
+                self._release(playback)
+                self._admit()
+        print(f"Finished processing command ID {playback.cmd_id}")
+        trace.emit(playback.cmd_id, "finished", repetition=playback.repetition)
+        event_bus.publish("command", {"id": playback.cmd_id, "state": "done"})
+
+scheduler = Scheduler()
+
+def queue_depth():
+    with scheduler.cond:
+        return {("pending",): len(scheduler.pending_by_id), ("active",): len(scheduler.active)}
+
+metrics.add(Gauge("intercom_queue_depth", "Commands waiting and playing on this node", queue_depth, ("state",)))
+metrics.add(Gauge("intercom_dispatcher", "1 if this node is the elected dispatcher", lambda: int(cluster.is_leader)))
+
+# --- Schedules ---
+class CronRule:
+    """A cron expression in local time: "minute hour day month weekday", with an
+    optional leading seconds field. Fields take *, numbers, a-b ranges, lists
+    and /steps; weekday 0 or 7 is Sunday. As in cron, when both day and
+    weekday are restricted a date matching either one fires.
+    """
+
+    FIELDS = (("second", 0, 59), ("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12),
+              ("weekday", 0, 7))
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) == 5:
+            parts = ["0"] + parts
+        if len(parts) != 6:
+            raise ValueError("expected 5 fields (minute hour day month weekday) or 6 with seconds first")
+        self.expression = expression
+        self.seconds, self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(part, name, low, high) for part, (name, low, high) in zip(parts, self.FIELDS))
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = parts[3] == "*"
+        self.any_weekday = parts[5] == "*"
+
+    @staticmethod
+    def _parse(field, name, low, high):
+        values = set()
+        for item in field.split(","):
+            span, _, step = item.partition("/")
+            try:
+                if span == "*":
+                    start, end = low, high
+                elif "-" in span:
+                    start, end = (int(value) for value in span.split("-", 1))
+                else:
+                    start = int(span)
+                    end = high if step else start  # "5/15": every 15 from 5
+                step = int(step) if step else 1
+            except ValueError:
+                raise ValueError(f"bad {name} field {item!r}")
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"{name} field {item!r} is outside {low}-{high}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = dt.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, ts):
+        """The first matching whole second after ts (epoch seconds); None if there isn't one within 5 years."""
+        dt = datetime.fromtimestamp(math.floor(ts) + 1)
+        last_year = dt.year + 5
+        # Jump a whole month/day/hour/minute at a time when that field doesn't match
+        while dt.year <= last_year:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0, second=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0, second=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0, second=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt = dt.replace(second=0) + timedelta(minutes=1)
+            elif dt.second not in self.seconds:
+                dt += timedelta(seconds=1)
+            else:
+                return dt.timestamp()
+        return None
+
+def schedule_members(schedule):
+    # The saved commands a schedule fires (none if its target was deleted)
+    if schedule.saved_command_id:
+        saved = SavedCommand.query.get(schedule.saved_command_id)
+        return [saved] if saved else []
+    if schedule.command_set_id:
+        set_obj = SavedCommandSet.query.get(schedule.command_set_id)
+        return list(set_obj.commands) if set_obj else []
+    return []
+
+class ScheduleEngine:
+    """Fires Schedule rows on time from one timer heap.
+
+    The next fire time of every enabled schedule is precomputed.
+    SCHEDULE_PREPARE_SECONDS before it, the schedule's playback plans are
+    compiled and the fan-out lead for its intercoms is estimated. The commands
+    are then queued just early enough for that lead, with start_at set to the
+    scheduled second, so the shared start_time lands on it. Only the elected
+    dispatcher fires, and each fire time is claimed in the database, so a
+    schedule never fires twice.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.rules = {}
+        self.next_fire = {}
+        self.generation = 0
+        self.counter = itertools.count()
+        self.thread = None
+
+    def start(self):
+        with app.app_context():
+            self.reload()
+        self.thread = threading.Thread(target=self._run, name="schedules", daemon=True)
+        self.thread.start()
+
+    def changed(self):
+        # After a schedule edit: reload here and tell the dispatcher if that's another process
+        if self.thread:
+            self.reload()
+        cluster.bump_catalog()
+
+    def reload(self):
+        """Rebuild the heap from the table. Needs an app context."""
+        schedules = Schedule.query.filter_by(enabled=True).all()
+        now = time.time()
+        with self.cond:
+            self.generation += 1
+            self.heap = []
+            self.rules = {}
+            self.next_fire = {}
+            for schedule in schedules:
+                try:
+                    self.rules[schedule.id] = CronRule(schedule.cron)
+                except ValueError as e:
+                    print(f"Schedule '{schedule.name}' has an invalid rule: {e}")
+                    continue
+                self._plan_next(schedule.id, max(now, schedule.last_fired_at or 0))
+            self.cond.notify()
+
+    def _push(self, due, phase, schedule_id, fire_at):
+        # Caller holds self.cond
+        heapq.heappush(self.heap, (due, next(self.counter), self.generation, phase, schedule_id, fire_at))
+        self.cond.notify()
+
+    def _plan_next(self, schedule_id, after):
+        # Caller holds self.cond
+        fire_at = self.rules[schedule_id].next_after(after)
+        self.next_fire[schedule_id] = fire_at
+        if fire_at is not None:
+            self._push(fire_at - SCHEDULE_PREPARE_SECONDS, "prepare", schedule_id, fire_at)
+
+    def _run(self):
+        while not stop_event.is_set():
+            with self.cond:
+                now = time.time()
+                if not self.heap or self.heap[0][0] > now:
+                    # Capped so a change to the wall clock is noticed
+                    self.cond.wait(min(self.heap[0][0] - now, 60) if self.heap else 60)
+                    continue
+                _, _, generation, phase, schedule_id, fire_at = heapq.heappop(self.heap)
+                if generation != self.generation:
+                    continue  # reloaded since
+            try:
+                with app.app_context():
+                    if phase == "prepare":
+                        self._prepare(schedule_id, fire_at, generation)
+                    else:
+                        self._fire(schedule_id, fire_at, generation)
+            except Exception as e:
+                print(f"Schedule {schedule_id} failed: {e}")
+
+    def _prepare(self, schedule_id, fire_at, generation):
+        schedule = Schedule.query.get(schedule_id)
+        target_ids = set()
+        for saved in schedule_members(schedule) if schedule else []:
+            plan = plan_cache.get(plan_key(saved))  # compiled now rather than at fire time
+            target_ids.update(target.intercom_id for target in plan.targets)
+        lead = latency_model.lead_time_ms(target_ids) / 1000.0
+        with self.cond:
+            if generation == self.generation:
+                self._push(fire_at - lead - SCHEDULE_ADMIT_MARGIN, "fire", schedule_id, fire_at)
+
+    def _fire(self, schedule_id, fire_at, generation):
+        try:
+            schedule = Schedule.query.get(schedule_id)
+            if not schedule or not schedule.enabled or not cluster.is_leader:
+                return
+            claimed = Schedule.query.filter(
+                Schedule.id == schedule_id,
+                db.or_(Schedule.last_fired_at.is_(None), Schedule.last_fired_at < fire_at),
+            ).update({"last_fired_at": fire_at})
+            if not claimed:
+                db.session.rollback()
+                return
+            # Committed together with the claim
+            cmds = queue_commands([command_from_saved(saved) for saved in schedule_members(schedule)],
+                                  triggered_at=time.time(), start_at=fire_at)
+            print(f"Schedule '{schedule.name}' queued {len(cmds)} command(s) for "
+                  f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(fire_at))}")
+        finally:
+            with self.cond:
+                if generation == self.generation:
+                    self._plan_next(schedule_id, fire_at)
+
+    def snapshot(self):
+        with self.cond:
+            return dict(self.next_fire)
+
+schedule_engine = ScheduleEngine()
+
+
+# --- Sound Sync ---
+LocalSound = namedtuple("LocalSound", "name path size sha256")
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+def file_sha256(path):
+    # Cached on (size, mtime) so unchanged files are only hashed once
+    st = os.stat(path)
+    with _hash_lock:
+        cached = _hash_cache.get(path)
+    if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    with _hash_lock:
+        _hash_cache[path] = (st.st_size, st.st_mtime_ns, digest.hexdigest())
+    return digest.hexdigest()
+
+def remember_sha256(path, sha256):
+    # For files hashed as they were written, so sync doesn't read them again
+    st = os.stat(path)
+    with _hash_lock:
+        _hash_cache[path] = (st.st_size, st.st_mtime_ns, sha256)
+
+def library_names():
+    # Just the file names, for queueing a push; the sync worker hashes them when it sends
+    return sorted(name for name in os.listdir(UPLOAD_FOLDER) if name.endswith(".wav"))
+
+def local_sounds(names=None):
+    sounds = []
+    for name in sorted(os.listdir(UPLOAD_FOLDER)):
+        if not name.endswith(".wav") or (names is not None and name not in names):
+            continue
+        path = os.path.join(UPLOAD_FOLDER, name)
+        sounds.append(LocalSound(name, path, os.path.getsize(path), file_sha256(path)))
+    return sounds
+
+def open_sftp(ip):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(ip, port=INTERCOM_SSH_PORT, username=INTERCOM_USERNAME, password=INTERCOM_PASSWORD, timeout=5)
+    return ssh, ssh.open_sftp()
+
+def part_name(sound):
+    # Tied to the content, so an upload is only ever resumed onto the same file
+    return f"{sound.name}.{sound.sha256[:16]}.part"
+
+def upload_resumable(sftp, sound, remote_path, progress):
+    """Upload via a .part file, appending to whatever an earlier attempt at this content left behind."""
+    part_path = f"{remote_path.rsplit('/', 1)[0]}/{part_name(sound)}"
+    try:
+        offset = sftp.stat(part_path).st_size
+    except IOError:
+        offset = 0
+    if offset > sound.size:
+        offset = 0
+
+    with open(sound.path, "rb") as local, sftp.open(part_path, "ab" if offset else "wb") as remote:
+        remote.set_pipelined(True)
+        local.seek(offset)
+        progress(offset)
+        for chunk in iter(lambda: local.read(SYNC_CHUNK_SIZE), b""):
+            remote.write(chunk)
+            progress(len(chunk))
+
+    if sftp.stat(part_path).st_size != sound.size:
+        raise IOError(f"size mismatch after uploading {sound.name}")
+    try:
+        sftp.posix_rename(part_path, remote_path)
+    except IOError:
+        try:
+            sftp.remove(remote_path)
+        except IOError:
+            pass
+        sftp.rename(part_path, remote_path)
+
+class SyncJob:
+    def __init__(self, job_id, targets, sounds):
+        self.id = job_id
+        self.created_at = time.time()
+        self.finished_at = None
+        self.sounds = sounds
+        self.devices = {
+            target.intercom_id: {
+                "name": target.name,
+                "ip": target.ip_address,
+                "state": "queued",
+                "files_total": 0,
+                "files_done": 0,
+                "bytes_total": 0,
+                "bytes_done": 0,
+                "error": None,
+            }
+            for target in targets
+        }
+
+    def to_dict(self):
+        states = [device["state"] for device in self.devices.values()]
+        return {
+            "id": self.id,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "files": len(self.sounds),
+            "done": sum(state in ("done", "failed") for state in states),
+            "failed": states.count("failed"),
+            "devices": self.devices,
+        }
+
+class SoundSync:
+    """Background sound sync to the intercoms.
+
+    Devices are synced concurrently on a pool of SSH/SFTP sessions. Each
+    device keeps a manifest of SHA-256 hashes next to its sounds; a file is
+    uploaded only when its hash differs from the manifest, and interrupted
+    uploads resume from the .part file left on the device.
+
+    Changed files are push()ed into a per-device outbox that a background
+    thread delivers; devices that can't be reached keep their outbox and are
+    retried every SYNC_RETRY_SECONDS or when retry() is called.
+    """
+
+    def __init__(self, concurrency=SYNC_CONCURRENCY):
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="sync")
+        self.jobs = {}
+        self.counter = itertools.count(1)
+        self.manifests = {}
+        self.outbox = {}
+        self.targets = {}
+        self.in_flight = set()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._push_loop, name="sync-push", daemon=True)
+        self.thread.start()
+
+    def push(self, names, targets):
+        """Queue sound file names for delivery to targets (PlanTarget tuples)."""
+        if self.thread is None:
+            # Web-only process: the dispatcher does the pushing
+            names = sorted(names)
+            if sum(len(name) for name in names) > 32768:
+                names = None  # the whole library; unchanged files are skipped by hash anyway
+            dispatch_notifier.send("sync", names=names, intercom_ids=[target.intercom_id for target in targets])
+            return
+        with self.lock:
+            for target in targets:
+                self.targets[target.intercom_id] = target
+                self.outbox.setdefault(target.intercom_id, set()).update(names)
+        self.wake.set()
+
+    def retry(self):
+        self.wake.set()
+
+    def forget(self, intercom_id):
+        # The device changed (e.g. new IP); don't trust what we knew about it
+        with self.lock:
+            self.manifests.pop(intercom_id, None)
+            self.outbox.pop(intercom_id, None)
+            self.targets.pop(intercom_id, None)
+        if self.thread is None:
+            dispatch_notifier.send("forget", intercom_id=intercom_id)
+
+    def handle_remote(self, message):
+        # A push or forget() forwarded by a web-only process
+        if message["kind"] == "forget":
+            self.forget(message["intercom_id"])
+            return
+        with app.app_context():
+            targets = [PlanTarget(intercom.id, intercom.name, intercom.ip_address) for intercom in
+                       read_session.query(Intercom).filter(Intercom.id.in_(message["intercom_ids"]))]
+        names = message["names"]
+        self.push(names if names is not None else library_names(), targets)
+
+    def has_sound(self, intercom_id, name):
+        """True/False if we know whether the device has the file, None if we don't."""
+        with self.lock:
+            manifest = self.manifests.get(intercom_id)
+            if manifest is not None and name in manifest:
+                return True
+            if manifest is not None or name in self.outbox.get(intercom_id, ()):
+                return False
+        return None
+
+    def pending(self):
+        with self.lock:
+            return {intercom_id: sorted(names) for intercom_id, names in self.outbox.items() if names}
+
+    def _push_loop(self):
+        while not stop_event.is_set():
+            self.wake.wait(SYNC_RETRY_SECONDS)
+            self.wake.clear()
+            with self.lock:
+                due = [self.targets[intercom_id] for intercom_id, names in self.outbox.items()
+                       if names and intercom_id not in self.in_flight]
+                names = set().union(*(self.outbox[target.intercom_id] for target in due))
+            if due:
+                self.start_job(due, local_sounds(names))
+
+    def start_job(self, targets, sounds=None):
+        """targets are PlanTarget tuples; sounds defaults to the whole library."""
+        sounds = local_sounds() if sounds is None else sounds
+        with self.lock:
+            job = SyncJob(next(self.counter), targets, sounds)
+            self.jobs[job.id] = job
+            while len(self.jobs) > SYNC_JOB_HISTORY:
+                del self.jobs[min(self.jobs)]
+            self.in_flight.update(target.intercom_id for target in targets)
+        futures = [self.pool.submit(self._sync_device, job, target) for target in targets]
+        threading.Thread(target=self._finish_job, args=(job, futures), daemon=True).start()
+        return job
+
+    def job(self, job_id=None):
+        with self.lock:
+            if job_id is None:
+                job_id = max(self.jobs, default=None)
+            return self.jobs.get(job_id)
+
+    def _finish_job(self, job, futures):
+        for future in futures:
+            future.result()
+        job.finished_at = time.time()
+        print(f"Sync job {job.id} finished: {job.to_dict()['failed']} device(s) failed")
+
+    def _load_manifest(self, intercom_id, ssh, sftp):
+        with self.lock:
+            manifest = dict(self.manifests.get(intercom_id) or {})
+        if not manifest:
+            try:
+                with sftp.open(f"{INTERCOM_SOUND_DIR}/{SYNC_MANIFEST_NAME}") as f:
+                    manifest = json.loads(f.read())
+            except (IOError, ValueError):
+                manifest = self._hash_remote(ssh)
+
+        # Drop entries for files that disappeared or changed size on the device
+        try:
+            present = {attr.filename: attr.st_size for attr in sftp.listdir_attr(INTERCOM_SOUND_DIR)}
+        except IOError:
+            sftp.mkdir(INTERCOM_SOUND_DIR)
+            present = {}
+        manifest = {name: entry for name, entry in manifest.items() if present.get(name) == entry.get("size")}
+        return manifest, present
+
+    @staticmethod
+    def _hash_remote(ssh):
+        # First sync against a device without a manifest: hash what's already there
+        manifest = {}
+        try:
+            _, stdout, _ = ssh.exec_command(f"cd {INTERCOM_SOUND_DIR} && sha256sum *.wav && stat -c '%n %s' *.wav", timeout=60)
+            lines = stdout.read().decode().splitlines()
+        except Exception:
+            return manifest
+        hashes, sizes = {}, {}
+        for line in lines:
+            first, _, rest = line.partition(" ")
+            if len(first) == 64 and rest.startswith(" "):
+                hashes[rest.strip()] = first
+            elif rest.isdigit():
+                sizes[first] = int(rest)
+        for name, digest in hashes.items():
+            if name in sizes:
+                manifest[name] = {"sha256": digest, "size": sizes[name]}
+        return manifest
+
+    def _save_manifest(self, intercom_id, sftp, manifest):
+        path = f"{INTERCOM_SOUND_DIR}/{SYNC_MANIFEST_NAME}"
+        with sftp.open(path + ".tmp", "wb") as f:
+            f.write(json.dumps(manifest, sort_keys=True).encode())
+        try:
+            sftp.posix_rename(path + ".tmp", path)
+        except IOError:
+            sftp.rename(path + ".tmp", path)
+        with self.lock:
+            self.manifests[intercom_id] = dict(manifest)
+
+    def _sync_device(self, job, target):
+        status = job.devices[target.intercom_id]
+        status["state"] = "connecting"
+        started = time.time()
+        try:
+            ssh, sftp = open_sftp(target.ip_address)
+            try:
+                manifest, present = self._load_manifest(target.intercom_id, ssh, sftp)
+                todo = [sound for sound in job.sounds if manifest.get(sound.name, {}).get("sha256") != sound.sha256]
+                # Partial uploads of this job's sounds from before they were edited (or delivered)
+                names = {sound.name for sound in job.sounds}
+                wanted = {part_name(sound) for sound in todo}
+                for name in present:
+                    if (name.endswith(".part") and name not in wanted
+                            and (name[:-5] in names or name[:-5].rsplit(".", 1)[0] in names)):
                         try:
-                            requests.get(url, timeout=1)
-                        except Exception as e:
-                            print(f"Failed to send to {intercom.name}: {e}")
-                        time.sleep(0.1)
-                    time.sleep(sound.play_duration_ms / 1000.0 + 2)
-                time.sleep(2)
-
-            elif cmd.announcement_id:
-                announcement = Announcement.query.get(cmd.announcement_id)
-                sound_ids = list(map(int, announcement.sound_order.split(',')))
-                for i in range(cmd.times_to_play):
-                    for sid in sound_ids:
-                        sound = Sound.query.get(sid)
-                        start_time = int(time.time()) + 5
-                        for intercom in targets:
-                            if intercom.disabled:
-                                continue
-
-                            volume = min(max(cmd.volume_modifier + intercom.volume_modifier + announcement.volume_modifier + sound.volume_modifier, 5), 100)
-                            url = f"http://{intercom.ip_address}:8084/?type=sound&message={sound.filename}&times=1&volume={volume}&priority=100&id={cmd.id}&start_time={start_time}"
-                            print(f"GET {url}")
-                            try:
-                                requests.get(url, timeout=1)
-                            except Exception as e:
-                                print(f"Failed to send to {intercom.name}: {e}")
-                            time.sleep(0.1)
-                        time.sleep(sound.play_duration_ms / 1000.0 + 2)
-                    time.sleep(2)
-
-            print(f"Finished processing command ID {cmd.id}")
-
-            if cmd.loop_forever:
-                command_queue.put(cmd.id)
+                            sftp.remove(f"{INTERCOM_SOUND_DIR}/{name}")
+                        except IOError:
+                            pass
+                status.update(state="syncing", files_total=len(todo), bytes_total=sum(sound.size for sound in todo))
+
+                def progress(n):
+                    status["bytes_done"] += n
+
+                for sound in todo:
+                    before = status["bytes_done"]
+                    upload_resumable(sftp, sound, f"{INTERCOM_SOUND_DIR}/{sound.name}", progress)
+                    sync_bytes.inc(status["bytes_done"] - before)
+                    sync_files.inc()
+                    manifest[sound.name] = {"sha256": sound.sha256, "size": sound.size}
+                    self._save_manifest(target.intercom_id, sftp, manifest)
+                    status["files_done"] += 1
+                if not todo:
+                    self._save_manifest(target.intercom_id, sftp, manifest)
+            finally:
+                sftp.close()
+                ssh.close()
+            status["state"] = "done"
+            sync_device_seconds.observe(time.time() - started, "ok")
+            print(f"Synced to {target.name}: {len(todo)} file(s) uploaded")
+            with self.lock:
+                # Everything in this job is delivered; names that no longer exist locally are dropped too
+                local_names = set(os.listdir(UPLOAD_FOLDER))
+                outbox = self.outbox.get(target.intercom_id)
+                if outbox:
+                    outbox.difference_update({sound.name for sound in job.sounds})
+                    outbox.intersection_update(local_names)
+        except Exception as e:
+            status.update(state="failed", error=str(e))
+            sync_device_seconds.observe(time.time() - started, "failed")
+            print(f"Sync failed for {target.name}: {e}")
+        finally:
+            with self.lock:
+                self.in_flight.discard(target.intercom_id)
+
+sound_sync = SoundSync()
+
+def fleet_targets():
+    return [PlanTarget(intercom.id, intercom.name, intercom.ip_address) for intercom in read_session.query(Intercom)]
+
+
+# --- Global Stop ---
+last_stop_report = {}
+
+def broadcast_stop(targets, clear_queue=False, requested_at=None):
+    """Send stopall to every target in parallel, with one retry pass.
+
+    With clear_queue, the queue table is emptied first, then the dispatcher
+    (this process, or another one over UDP) cancels those commands' scheduled
+    steps and lets steps already being dispatched finish, so no sound lands
+    after the stop.
+    Returns a report with time-to-silence per device (from requested_at to
+    the device confirming the stop) and the devices that never confirmed.
+    """
+    global last_stop_report
+    requested_at = requested_at or time.time()
+    if clear_queue:
+        AnnouncementCommand.query.delete()
+        db.session.commit()
+        event_bus.publish("queue_cleared", {})
+        if cluster.is_leader:
+            command_store.reconcile()
+            scheduler.wait_idle(DISPATCH_TIMEOUT)
+        elif not dispatch_notifier.request("stop", DISPATCH_TIMEOUT + 1):
+            print("The dispatcher didn't confirm; it drops the cleared commands at its next poll")
+
+    def stop_jobs(stop_targets):
+        return [(target.intercom_id, target.name, intercom_url(target.ip_address, type="cmd", cmd="stopall"))
+                for target in stop_targets]
+
+    results = {r["intercom_id"]: r for r in dispatch_step(stop_jobs(targets), label="stop all", timeout=STOP_TIMEOUT, kind="stop")}
+    retry = [target for target in targets if not results[target.intercom_id]["ok"]]
+    if retry:
+        for r in dispatch_step(stop_jobs(retry), label="stop all (retry)", timeout=STOP_RETRY_TIMEOUT,
+                               kind="stop"):
+            results[r["intercom_id"]] = r
+
+    devices = []
+    for target in targets:
+        r = results[target.intercom_id]
+        devices.append({
+            "intercom_id": target.intercom_id,
+            "name": target.name,
+            "confirmed": r["ok"],
+            "time_to_silence_ms": round((r["finished_at"] - requested_at) * 1000, 1) if r["ok"] else None,
+            "error": r["error"],
+            "retried": target in retry,
+        })
+    confirmed = [device["time_to_silence_ms"] for device in devices if device["confirmed"]]
+    last_stop_report = {
+        "requested_at": requested_at,
+        "cleared_queue": clear_queue,
+        "devices": devices,
+        "unconfirmed": [device["name"] for device in devices if not device["confirmed"]],
+        "max_time_to_silence_ms": max(confirmed, default=None),
+    }
+    return last_stop_report
+
+def stop_response(report, message):
+    if request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json":
+        return jsonify(report)
+    if report["unconfirmed"]:
+        message += f" No confirmation from: {', '.join(report['unconfirmed'])}."
+    flash(message)
+    return redirect(url_for("view_commands"))
+
+
+# --- Announcement Rendering ---
+RenderedSound = namedtuple("RenderedSound", "name duration_ms size announcement_id")
+
+class RenderError(Exception):
+    pass
+
+def pcm_to_float(frames, sample_width, channels=1):
+    """Decode PCM frames into float32 samples in [-1, 1), shaped (frames, channels)."""
+    if sample_width == 1:
+        # 8-bit WAV is unsigned around 128
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 3:
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        ints = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples = (np.where(ints & 0x800000, ints - 0x1000000, ints) / float(1 << 23)).astype(np.float32)
+    elif sample_width in (2, 4):
+        ints = np.frombuffer(frames, dtype="<i2" if sample_width == 2 else "<i4")
+        samples = (ints / float(1 << (8 * sample_width - 1))).astype(np.float32)
+    else:
+        raise RenderError(f"unsupported sample width {sample_width}")
+    return samples.reshape(-1, channels)
+
+def float_to_pcm(samples, sample_width):
+    scale = float(1 << (8 * sample_width - 1))
+    ints = np.clip(np.round(samples.astype(np.float64) * scale), -scale, scale - 1).astype(np.int32)
+    if sample_width == 1:
+        return (ints + 128).astype(np.uint8).tobytes()
+    if sample_width == 3:
+        return ints.astype("<i4").view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return ints.astype("<i2" if sample_width == 2 else "<i4").tobytes()
+
+def scale_samples(frames, sample_width, gain):
+    return float_to_pcm(pcm_to_float(frames, sample_width) * gain, sample_width)
+
+def render_announcement(paths, gains, gaps_ms, out_path):
+    """Concatenate WAVs (same format required) with a per-file gain and gaps_ms[i] of silence after file i."""
+    params = None
+    chunks = []
+    for i, (path, gain) in enumerate(zip(paths, gains)):
+        with wave.open(path, "rb") as wav_file:
+            fmt = (wav_file.getnchannels(), wav_file.getsampwidth(), wav_file.getframerate())
+            if params is None:
+                params = fmt
+            elif fmt != params:
+                raise RenderError(f"{os.path.basename(path)} is {fmt}, expected {params}")
+            frames = wav_file.readframes(wav_file.getnframes())
+        if i:
+            channels, width, rate = params
+            silence = b"\x80" if width == 1 else b"\x00"
+            chunks.append(silence * (int(rate * gaps_ms[i - 1] / 1000) * channels * width))
+        chunks.append(frames if gain == 1 else scale_samples(frames, params[1], gain))
+
+    tmp_path = out_path + ".tmp"
+    with wave.open(tmp_path, "wb") as out:
+        out.setnchannels(params[0])
+        out.setsampwidth(params[1])
+        out.setframerate(params[2])
+        for chunk in chunks:
+            out.writeframes(chunk)
+    os.replace(tmp_path, out_path)
+
+class RenderCache:
+    """Announcements pre-rendered into single WAVs, keyed by content and gains.
+
+    The key hashes each sound's file hash, the order, the relative gains and
+    the gap, so an edited sound or announcement simply renders under a new
+    key. Files live in UPLOAD_FOLDER as _render_<announcement id>_<key>.wav
+    and are evicted least-recently-used once they take more than max_bytes;
+    load() picks up the ones an earlier run left behind.
+    """
+
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.max_bytes = max_bytes
+
+    def for_targets(self, announcement_id, plan, targets):
+        """Map plan target index -> (RenderedSound, device volume), or None to fall back.
+
+        Renders are pushed to targets that don't have them yet; until every
+        target does, the caller should dispatch item by item.
+        """
+        if np is None:
+            return None
+        result = {}
+        missing = []
+        try:
+            for index, target in targets:
+                render, volume = self.get(announcement_id, plan.steps, [step.volumes[index] for step in plan.steps])
+                result[index] = (render, volume)
+                if sound_sync.has_sound(target.intercom_id, render.name + ".wav") is not True:
+                    missing.append((target, render))
+        except (RenderError, OSError, wave.Error) as e:
+            print(f"Can't render announcement {announcement_id}: {e}")
+            return None
+        for render_name in {render.name for _, render in missing}:
+            sound_sync.push([render_name + ".wav"], [target for target, render in missing if render.name == render_name])
+        return None if missing else result
+
+    def get(self, announcement_id, steps, volumes):
+        # The loudest item plays at the requested volume; the rest are scaled down in the render
+        device_volume = max(volumes)
+        gains = tuple(round(volume / device_volume, 3) if device_volume else 1.0 for volume in volumes)
+        paths = [os.path.join(UPLOAD_FOLDER, f"{step.filename}.wav") for step in steps]
+        key = hashlib.sha256(json.dumps(
+            [[step.filename, file_sha256(path), step_gap_ms(step, ANNOUNCEMENT_GAP_MS)] for step, path in zip(steps, paths)]
+            + [gains]
+        ).encode()).hexdigest()[:16]
+        name = f"{RENDER_PREFIX}{announcement_id}_{key}"
+        out_path = os.path.join(UPLOAD_FOLDER, f"{name}.wav")
+
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and os.path.exists(out_path):
+                self.entries.move_to_end(name)
+                return entry, device_volume
+
+        if not os.path.exists(out_path):
+            render_announcement(paths, gains, [step_gap_ms(step, ANNOUNCEMENT_GAP_MS) for step in steps], out_path)
+            print(f"Rendered announcement {announcement_id} to {name}.wav")
+        entry = RenderedSound(name, get_wav_duration_ms(out_path), os.path.getsize(out_path), announcement_id)
+        with self.lock:
+            if name in self.entries:
+                self.size -= self.entries[name].size  # its file went missing and was rendered again
+            self.entries[name] = entry
+            self.size += entry.size
+            self._evict()
+        return entry, device_volume
+
+    def load(self):
+        # Renders from an earlier run, oldest first, so they count towards
+        # max_bytes and can be evicted and invalidated like new ones
+        found = []
+        for filename in os.listdir(UPLOAD_FOLDER):
+            if not (filename.startswith(RENDER_PREFIX) and filename.endswith(".wav")):
+                continue
+            path = os.path.join(UPLOAD_FOLDER, filename)
+            name = filename[:-4]
+            announcement_id, _, key = name[len(RENDER_PREFIX):].partition("_")
+            try:
+                if not announcement_id.isdigit() or not key:
+                    os.remove(path)  # named before renders carried their announcement; never looked up again
+                    continue
+                found.append((os.path.getmtime(path), RenderedSound(
+                    name, get_wav_duration_ms(path), os.path.getsize(path), int(announcement_id))))
+            except (OSError, wave.Error, EOFError) as e:
+                print(f"Skipping render {filename}: {e}")
+        found.sort(key=lambda item: item[0])
+        with self.lock:
+            for _, entry in found:
+                if entry.name not in self.entries:
+                    self.entries[entry.name] = entry
+                    self.size += entry.size
+            self._evict()
+        return len(found)
+
+    def invalidate_announcement(self, announcement_id):
+        # Also called on web workers, whose cache is empty, so match files on disk by name
+        prefix = f"{RENDER_PREFIX}{announcement_id}_"
+        with self.lock:
+            for name in [name for name in self.entries if name.startswith(prefix)]:
+                self._remove(name)
+            for filename in os.listdir(UPLOAD_FOLDER):
+                if filename.startswith(prefix) and filename.endswith(".wav"):
+                    try:
+                        os.remove(os.path.join(UPLOAD_FOLDER, filename))
+                    except OSError:
+                        pass
+
+    def _evict(self):
+        # Caller holds self.lock
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, name):
+        entry = self.entries.pop(name)
+        self.size -= entry.size
+        try:
+            os.remove(os.path.join(UPLOAD_FOLDER, f"{entry.name}.wav"))
+        except OSError:
+            pass
+
+render_cache = RenderCache()
+
+
+# --- Sound Ingest ---
+WavInfo = namedtuple("WavInfo", "channels sample_width sample_rate frames duration_ms")
+
+class IngestError(Exception):
+    pass
+
+def incoming_folder():
+    path = os.path.join(UPLOAD_FOLDER, INCOMING_FOLDER_NAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+class UploadSpool:
+    """Temp file the multipart parser streams an upload into, hashing it as it arrives."""
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(suffix=".part", dir=incoming_folder())
+        self.file = os.fdopen(fd, "w+b")
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class IngestRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpool()
+
+app.request_class = IngestRequest
+
+def read_wav_info(path):
+    try:
+        with wave.open(path, "rb") as wav_file:
+            info = WavInfo(wav_file.getnchannels(), wav_file.getsampwidth(), wav_file.getframerate(),
+                           wav_file.getnframes(), 0)
+    except (wave.Error, EOFError) as e:
+        raise IngestError(f"not a PCM WAV file ({e})")
+    if not info.frames or not info.sample_rate:
+        raise IngestError("WAV file has no audio")
+    if os.path.getsize(path) < info.frames * info.channels * info.sample_width:
+        raise IngestError("WAV file is truncated")
+    return info._replace(duration_ms=int(info.frames * 1000 / info.sample_rate))
+
+def needs_conversion(info):
+    return any(want and want != have for want, have in ((DEVICE_SAMPLE_RATE, info.sample_rate),
+                                                      (DEVICE_CHANNELS, info.channels),
+                                                      (DEVICE_SAMPLE_WIDTH, info.sample_width)))
+
+def convert_wav(path, info, out_path):
+    """Rewrite a WAV in the DEVICE_* format: channels mixed down/up, linear-interpolation resample."""
+    with wave.open(path, "rb") as wav_file:
+        samples = pcm_to_float(wav_file.readframes(info.frames), info.sample_width, info.channels)
+    channels = DEVICE_CHANNELS or info.channels
+    if channels != info.channels:
+        samples = np.repeat(samples.mean(axis=1, keepdims=True), channels, axis=1)
+    rate = DEVICE_SAMPLE_RATE or info.sample_rate
+    if rate != info.sample_rate:
+        count = int(round(len(samples) * rate / info.sample_rate))
+        src = np.arange(len(samples)) / info.sample_rate
+        dst = np.arange(count) / rate
+        samples = np.stack([np.interp(dst, src, samples[:, c]) for c in range(channels)], axis=1)
+    width = DEVICE_SAMPLE_WIDTH or info.sample_width
+    with wave.open(out_path, "wb") as out:
+        out.setnchannels(channels)
+        out.setsampwidth(width)
+        out.setframerate(rate)
+        out.writeframes(float_to_pcm(samples, width))
+
+def install_sound(sound, spool_path, info, sha256):
+    """Move a validated upload into UPLOAD_FOLDER, record its metadata and push it to the fleet."""
+    dest = os.path.join(UPLOAD_FOLDER, f"{sound.filename}.wav")
+    os.replace(spool_path, dest)
+    remember_sha256(dest, sha256)
+    sound.play_duration_ms = info.duration_ms
+    sound.sample_rate = info.sample_rate
+    sound.channels = info.channels
+    sound.sample_width = info.sample_width
+    sound.file_size = os.path.getsize(dest)
+    sound.sha256 = sha256
+    sound.status = "ready"
+    db.session.commit()
+    plan_cache.invalidate()
+    sound_sync.push([f"{sound.filename}.wav"], fleet_targets())
+    if LOUDNESS_NORMALIZATION != "off" and np is not None:
+        ingest_executor.submit(analyze_sounds, [sound.id])
+
+def convert_upload(sound_id, spool_path, info):
+    # Runs on ingest_executor; the sound stays "processing" until it's in place
+    converted_path = spool_path + ".converted"
+    with app.app_context():
+        sound = Sound.query.get(sound_id)
+        try:
+            convert_wav(spool_path, info, converted_path)
+            install_sound(sound, converted_path, read_wav_info(converted_path), file_sha256(converted_path))
+            print(f"Converted {sound.filename}.wav to {sound.sample_rate} Hz, {sound.channels} ch, "
+                  f"{sound.sample_width * 8}-bit")
+        except Exception as e:
+            print(f"Converting {sound.filename}.wav failed: {e}")
+            sound.status = "failed"
+            db.session.commit()
+        finally:
+            for path in (spool_path, converted_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+ingest_executor = ThreadPoolExecutor(max_workers=1)
+
+def clean_incoming(max_age=3600):
+    # Spools left behind by uploads that were cut off mid-stream
+    folder = incoming_folder()
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except FileNotFoundError:
+            pass  # another worker starting up got to it first
+
+
+# --- Loudness ---
+def measure_loudness(path):
+    """(loudness_db, peak_db) of a WAV: mean power of 400 ms blocks, gated at -70 dBFS and 10 dB below the mean."""
+    with wave.open(path, "rb") as wav_file:
+        channels = wav_file.getnchannels()
+        rate = wav_file.getframerate()
+        samples = pcm_to_float(wav_file.readframes(wav_file.getnframes()), wav_file.getsampwidth(), channels)
+    if not len(samples):
+        return None, None
+    peak = float(np.abs(samples).max())
+
+    block = max(int(rate * 0.4), 1)
+    count = len(samples) // block
+    if count:
+        power = (samples[:count * block].reshape(count, block, channels) ** 2).mean(axis=1).sum(axis=1)
+    else:
+        power = (samples ** 2).mean(axis=0).sum(keepdims=True)
+    power = power[power > 1e-7]
+    if power.size:
+        power = power[power > power.mean() * 0.1]
+    loudness = round(10 * math.log10(power.mean()), 2) if power.size else None
+    return loudness, (round(20 * math.log10(peak), 2) if peak else None)
+
+def suggested_gain(loudness_db):
+    if loudness_db is None:
+        return 1.0
+    gain = 10 ** ((LOUDNESS_TARGET_DB - loudness_db) / 20)
+    return round(min(max(gain, LOUDNESS_MIN_GAIN), LOUDNESS_MAX_GAIN), 2)
+
+def analyze_sounds(sound_ids=None):
+    # Runs on ingest_executor; files whose hash hasn't changed keep their analysis
+    with app.app_context():
+        query = Sound.query if sound_ids is None else Sound.query.filter(Sound.id.in_(sound_ids))
+        analyzed = 0
+        changed = False
+        for sound in query.all():
+            path = os.path.join(UPLOAD_FOLDER, f"{sound.filename}.wav")
+            if sound.status == "processing" or not os.path.exists(path):
+                continue
+            sha256 = file_sha256(path)
+            if sound.loudness_sha256 != sha256:
+                try:
+                    sound.loudness_db, sound.peak_db = measure_loudness(path)
+                except (RenderError, wave.Error, EOFError, ValueError) as e:
+                    print(f"Can't measure loudness of {sound.filename}.wav: {e}")
+                    continue
+                sound.loudness_sha256 = sha256
+                analyzed += 1
+            if LOUDNESS_NORMALIZATION == "apply":
+                gain = suggested_gain(sound.loudness_db)
+                if gain != (sound.loudness_gain or 1.0):
+                    sound.loudness_gain = gain
+                    changed = True
+        db.session.commit()
+        if changed:
+            plan_cache.invalidate()
+        print(f"Loudness analysis: measured {analyzed} sound(s)")
+
+
+# --- Health Monitor ---
+class HealthMonitor:
+    """Probes every intercom's /status concurrently on a schedule.
+
+    The latest status, latency and last-seen time per device are kept in
+    memory for the status page and API, and the dispatcher skips devices
+    that are known to be down instead of waiting out a timeout on each step.
+    Only the elected dispatcher probes; other processes relay the status
+    routes to it.
+    """
+
+    def __init__(self, interval=HEALTH_PROBE_INTERVAL, concurrency=HEALTH_CONCURRENCY):
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="health")
+        self.interval = interval
+        self.status = {}
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="health-monitor", daemon=True)
+        self.thread.start()
+
+    def refresh(self):
+        self.wake.set()
+
+    def is_down(self, intercom_id):
+        entry = self.status.get(intercom_id)
+        return entry is not None and entry["failures"] >= HEALTH_DOWN_AFTER
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(entry) for entry in self.status.values()]
+
+    def _run(self):
+        while not stop_event.is_set():
+            try:
+                if cluster.is_leader:
+                    with app.app_context():
+                        targets = fleet_targets()
+                    self.probe_all(targets)
+            except Exception as e:
+                print(f"Health probe round failed: {e}")
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def probe_all(self, targets):
+        with self.lock:
+            known = {target.intercom_id for target in targets}
+            for intercom_id in list(self.status):
+                if intercom_id not in known:
+                    del self.status[intercom_id]
+        for future in [self.pool.submit(self._probe, target) for target in targets]:
+            future.result()
+
+    def _probe(self, target):
+        url = f"http://{target.ip_address}:{INTERCOM_HTTP_PORT}/status"
+        started = time.time()
+        try:
+            response = get_http_session().get(url, timeout=HEALTH_PROBE_TIMEOUT)
+            online, result = True, response.text if response.ok else None
+        except Exception:
+            online, result = False, None
+        now = time.time()
+        latency_ms = round((now - started) * 1000, 1)
+
+        with self.lock:
+            entry = self.status.setdefault(target.intercom_id, {
+                "intercom_id": target.intercom_id,
+                "online": None,
+                "failures": 0,
+                "last_seen": None,
+            })
+            came_back = online and entry["online"] is False
+            changed = online != entry["online"] or (online and result != entry.get("response"))
+            entry.update(name=target.name, ip=target.ip_address, online=online, last_checked=now,
+                         latency_ms=latency_ms if online else None)
+            if online:
+                entry.update(response=result, failures=0, last_seen=now)
             else:
-                db.session.delete(cmd)
-                db.session.commit()
+                entry.update(response=None, failures=entry["failures"] + 1)
+            snapshot = dict(entry)
+
+        if changed:
+            event_bus.publish("health", snapshot)
+        if online:
+            latency_model.observe(target.intercom_id, latency_ms)
+        if came_back:
+            print(f"{target.name} is back online")
+            sound_sync.retry()
 
-        time.sleep(2)
-        command_queue.task_done()
+health_monitor = HealthMonitor()
 
 
 # --- Routes for remaining templates ---
 @app.route("/intercoms")
 def view_intercoms():
-    intercoms = Intercom.query.all()
-    return render_template("intercoms.html", intercoms=intercoms)
+    page = paginate(Intercom.query.order_by(Intercom.id))
+    return render_template("intercoms.html", intercoms=page.items, page=page)
 
 @app.route("/intercoms/add", methods=["GET", "POST"])
 def add_intercom():
@@ -194,107 +3132,163 @@ def add_intercom():
         name = request.form["name"]
         ip = request.form["ip_address"]
         volume_modifier = int(request.form.get("volume_modifier", 0))
-        intercom.disabled = "disabled" in request.form  # for both add and edit
         intercom = Intercom(name=name, ip_address=ip, volume_modifier=volume_modifier)
+        intercom.disabled = "disabled" in request.form  # for both add and edit
         db.session.add(intercom)
         db.session.commit()
+        membership_index.put_intercom(intercom)
+        plan_cache.invalidate()  # bumps the catalog, so a dispatcher in another process reloads its index
+        # A new device needs the whole library
+        sound_sync.push(library_names(), [PlanTarget(intercom.id, intercom.name, intercom.ip_address)])
         return redirect(url_for("view_intercoms"))
     return render_template("add_intercom.html")
 
 @app.route("/groups")
 def view_groups():
-    groups = IntercomGroup.query.all()
-    return render_template("groups.html", groups=groups)
+    page = paginate(IntercomGroup.query.options(selectinload(IntercomGroup.intercoms), selectinload(IntercomGroup.subgroups))
+                    .order_by(IntercomGroup.id))
+    cluster.sync_catalog()  # the index is only as fresh as this process's last catalog check
+    reach = {group.id: len(membership_index.expand(group.id)) for group in page.items}
+    return render_template("groups.html", groups=page.items, page=page, reach=reach)
 
 @app.route("/commands/stopall")
+@dispatcher_state
 def stop_all_playback():
-    intercoms = Intercom.query.all()
-    for intercom in intercoms:
-        try:
-            url = f"http://{intercom.ip_address}:8084/?type=cmd&cmd=stopall"
-            print(f"Sending stop to: {url}")
-            requests.get(url, timeout=1)
-        except Exception as e:
-            print(f"Failed to stop intercom {intercom.name}: {e}")
-    flash("Stop command sent to all intercoms.")
-    return redirect(url_for("view_commands"))
+    requested_at = time.time()
+    report = broadcast_stop(fleet_targets(), requested_at=requested_at)
+    return stop_response(report, "Stop command sent to all intercoms.")
+
+@app.route("/commands/stop_report")
+@dispatcher_state
+def view_stop_report():
+    return jsonify(last_stop_report)
 
 @app.route("/groups/add", methods=["GET", "POST"])
 def add_group():
-    intercoms = Intercom.query.all()
+    intercoms = catalog.options("intercoms")
     if request.method == "POST":
         name = request.form["name"]
-        intercom_ids = request.form.getlist("intercom_ids")
+        intercom_ids = [int(id) for id in request.form.getlist("intercom_ids")]
+        child_ids = [int(id) for id in request.form.getlist("child_group_ids")]
         group = IntercomGroup(name=name)
         db.session.add(group)
         db.session.commit()
 
         for intercom_id in intercom_ids:
             db.session.add(GroupMembership(intercom_id=intercom_id, intercom_group_id=group.id))
+        # A new group has no parents yet, so any existing group can go under it
+        for child_id in child_ids:
+            db.session.add(GroupNesting(parent_group_id=group.id, child_group_id=child_id))
         db.session.commit()
+        membership_index.put_group(group.id, intercom_ids, child_ids)
+        plan_cache.invalidate()  # bumps the catalog, so a dispatcher in another process reloads its index
 
         return redirect(url_for("view_groups"))
-    return render_template("add_group.html", intercoms=intercoms)
+    return render_template("add_group.html", intercoms=intercoms, groups=catalog.options("groups"))
+
+def nesting_loops(group_id, child_ids):
+    # Children that would make group_id contain itself, read from the database
+    # rather than the index, which may not have seen edits made by other processes
+    children = {}
+    for parent_id, child_id in db.session.query(GroupNesting.parent_group_id, GroupNesting.child_group_id):
+        children.setdefault(parent_id, set()).add(child_id)
+    looped = []
+    for child_id in child_ids:
+        seen, stack = set(), [child_id]
+        while stack:
+            current = stack.pop()
+            if current not in seen:
+                seen.add(current)
+                stack.extend(children.get(current, ()))
+        if group_id in seen:
+            looped.append(child_id)
+    return looped
 
 @app.route("/groups/edit/<int:id>", methods=["GET", "POST"])
 def edit_group(id):
     group = IntercomGroup.query.get_or_404(id)
-    intercoms = Intercom.query.all()
+    intercoms = catalog.options("intercoms")
 
     if request.method == "POST":
+        intercom_ids = [int(id) for id in request.form.getlist("intercom_ids")]
+        child_ids = [int(id) for id in request.form.getlist("child_group_ids")]
         group.name = request.form["name"]
-        db.session.commit()
 
         # Clear existing memberships
         GroupMembership.query.filter_by(intercom_group_id=group.id).delete()
+        GroupNesting.query.filter_by(parent_group_id=group.id).delete()
 
         # Add new memberships
-        intercom_ids = request.form.getlist("intercom_ids")
         for intercom_id in intercom_ids:
             db.session.add(GroupMembership(intercom_id=intercom_id, intercom_group_id=group.id))
+        for child_id in child_ids:
+            db.session.add(GroupNesting(parent_group_id=group.id, child_group_id=child_id))
+        db.session.flush()
+
+        # Refuse anything that would make the group contain itself. Checked after
+        # this edit's own writes: they hold SQLite's write lock, so an edit in
+        # another worker can't close a loop with this one before it commits.
+        if nesting_loops(group.id, child_ids):
+            db.session.rollback()
+            flash("A group can't include itself or a group that already includes it.")
+            return redirect(url_for("edit_group", id=group.id))
         db.session.commit()
+        membership_index.put_group(group.id, intercom_ids, child_ids)
+        plan_cache.invalidate()
 
         return redirect(url_for("view_groups"))
 
-    return render_template("add_group.html", group=group, intercoms=intercoms)
+    member_ids = {intercom_id for (intercom_id,) in db.session.query(GroupMembership.intercom_id)
+                  .filter_by(intercom_group_id=group.id)}
+    child_ids = {child_id for (child_id,) in db.session.query(GroupNesting.child_group_id)
+                 .filter_by(parent_group_id=group.id)}
+    # Groups that already include this one can't go under it
+    cluster.sync_catalog()
+    ancestors = membership_index.ancestors(group.id)
+    groups = [g for g in catalog.options("groups") if g.id not in ancestors]
+    return render_template("add_group.html", group=group, intercoms=intercoms, member_ids=member_ids,
+                           groups=groups, child_ids=child_ids)
 @app.route("/intercoms/edit/<int:id>", methods=["GET", "POST"])
 def edit_intercom(id):
     intercom = Intercom.query.get_or_404(id)
     if request.method == "POST":
+        old_ip = intercom.ip_address
         intercom.name = request.form["name"]
         intercom.ip_address = request.form["ip_address"]
         intercom.volume_modifier = int(request.form["volume_modifier"])
         intercom.disabled = "disabled" in request.form  # for both add and edit
         db.session.commit()
+        membership_index.put_intercom(intercom)
+        plan_cache.invalidate()
+        if intercom.ip_address != old_ip:
+            sound_sync.forget(intercom.id)
+            sound_sync.push(library_names(), [PlanTarget(intercom.id, intercom.name, intercom.ip_address)])
         return redirect(url_for("view_intercoms"))
     return render_template("add_intercom.html", intercom=intercom)
 
 
 @app.route("/announcements")
 def view_announcements():
-    announcements = Announcement.query.all()
-    sounds = {s.id: s.name for s in Sound.query.all()}
-    return render_template("announcements.html", announcements=announcements, sounds=sounds)
+    page = paginate(Announcement.query.options(
+        selectinload(Announcement.items).selectinload(AnnouncementItem.sound)).order_by(Announcement.id))
+    return render_template("announcements.html", announcements=page.items, page=page)
 
 @app.route("/announcements/add", methods=["GET", "POST"])
 def add_announcement():
     if request.method == "POST":
         name = request.form["name"]
         volume_modifier = int(request.form.get("volume_modifier", 0))
-        sound_order_ids = request.form.getlist("sound_order[]")
-        sound_order = ",".join(sound_order_ids)  # Convert to comma-separated string
-
         ann = Announcement(
             name=name,
             volume_modifier=volume_modifier,
-            sound_order=sound_order
         )
+        ann.set_items(request.form.getlist("sound_order[]"), request.form.getlist("item_volume[]"),
+                      request.form.getlist("item_gap[]"))
         db.session.add(ann)
         db.session.commit()
         return redirect(url_for("view_announcements"))
 
-    sounds = Sound.query.all()
-    return render_template("add_announcement.html", sounds=sounds)
+    return render_template("add_announcement.html", sounds=catalog.options("sounds"))
 
 
 @app.route("/commands/add", methods=["GET", "POST"])
@@ -307,6 +3301,7 @@ def add_command():
         volume = int(request.form.get("volume", 50))
         times = int(request.form.get("times", 1))
         loop = request.form.get("loop") == "on"
+        priority = int(request.form.get("priority", DEFAULT_PRIORITY))
 
         cmd = AnnouncementCommand(
             intercom_id=intercom_id,
@@ -315,18 +3310,16 @@ def add_command():
             sound_id=sound_id,
             volume_modifier=volume,
             times_to_play=times,
-            loop_forever=loop
+            loop_forever=loop,
+            priority=priority
         )
         db.session.add(cmd)
         db.session.commit()
-        command_queue.put(cmd.id)
+        command_store.submit(cmd)
         return redirect(url_for("view_commands"))
 
-    intercoms = Intercom.query.all()
-    groups = IntercomGroup.query.all()
-    announcements = Announcement.query.all()
-    sounds = Sound.query.all()
-    return render_template("add_command.html", intercoms=intercoms, groups=groups, announcements=announcements, sounds=sounds)
+    return render_template("add_command.html", intercoms=catalog.options("intercoms"), groups=catalog.options("groups"),
+                           announcements=catalog.options("announcements"), sounds=catalog.options("sounds"))
 
 @app.route("/sounds/add", methods=["GET", "POST"])
 def add_sound():
@@ -339,31 +3332,135 @@ def add_sound():
         sound = Sound(name=name, filename=filename, play_duration_ms=play_duration_ms, volume_modifier=volume_modifier)
         db.session.add(sound)
         db.session.commit()
+        if os.path.exists(os.path.join(UPLOAD_FOLDER, f"{filename}.wav")):
+            sound_sync.push([f"{filename}.wav"], fleet_targets())
         return redirect(url_for("view_sounds"))
 
     return render_template("add_sound.html")
 
 @app.route("/commands/delete/<int:cmd_id>")
+@dispatcher_state
 def delete_command(cmd_id):
     cmd = AnnouncementCommand.query.get(cmd_id)
     if cmd:
         db.session.delete(cmd)
         db.session.commit()
+    scheduler.cancel(cmd_id)
     return redirect(url_for("view_commands"))
 
 @app.route("/commands")
 def view_commands():
-    commands = AnnouncementCommand.query.all()
-    intercoms = {i.id: i.name for i in Intercom.query.all()}
-    groups = {g.id: g.name for g in IntercomGroup.query.all()}
-    announcements = {a.id: a.name for a in Announcement.query.all()}
-    sounds = {s.id: s.name for s in Sound.query.all()}
-    return render_template("commands.html", commands=commands, intercoms=intercoms, groups=groups, announcements=announcements, sounds=sounds)
+    page = paginate(read_session.query(AnnouncementCommand).filter(AnnouncementCommand.state != "done")
+                    .order_by(AnnouncementCommand.id))
+    if cluster.is_leader:
+        state = scheduler.snapshot()
+        active, pending = set(state["active"]), set(state["pending"])
+    else:
+        # The dispatcher is another process; its progress reaches the rows every QUEUE_FLUSH_INTERVAL
+        active = {cmd.id for cmd in page.items if cmd.state in ("dispatching", "playing")}
+        pending = {cmd.id for cmd in page.items if cmd.state == "pending"}
+    return render_template("commands.html", commands=page.items, page=page,
+                           intercoms=catalog.names("intercoms"), groups=catalog.names("groups"),
+                           announcements=catalog.names("announcements"), sounds=catalog.names("sounds"),
+                           active=active, pending=pending)
+
+@app.route("/events")
+@dispatcher_state
+def event_stream():
+    # Server-sent events for the dashboards: command, dispatch, health, queue_cleared
+    q = event_bus.subscribe()
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    yield q.get(timeout=EVENT_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            event_bus.unsubscribe(q)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/commands/dispatch_log")
+@dispatcher_state
+def view_dispatch_log():
+    # Most recent step first, with per-device latency and success
+    return jsonify(list(reversed(dispatch_log)))
+
+@app.route("/commands/latency")
+@dispatcher_state
+def view_latency_model():
+    return jsonify(latency_model.snapshot())
+
+@app.route("/commands/trigger_latency")
+@dispatcher_state
+def view_trigger_latency():
+    return jsonify(scheduler.trigger_latency_stats())
+
+@app.route("/metrics")
+@dispatcher_state
+def view_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/cluster")
+def view_cluster():
+    return jsonify(cluster.snapshot())
+
+@app.route("/commands/queue_stats")
+@dispatcher_state
+def view_queue_stats():
+    # Queue depth, rows per state and time from queued to first dispatch
+    return jsonify(command_store.stats())
 
 @app.route("/sounds")
 def view_sounds():
-    sounds = Sound.query.all()
-    return render_template("sounds.html", sounds=sounds)
+    page = paginate(Sound.query.order_by(Sound.id))
+    return render_template("sounds.html", sounds=page.items, page=page, suggested_gain=suggested_gain)
+
+@app.route("/sounds/delete/<int:id>")
+def delete_sound(id):
+    # Refused while anything still plays it, so plans never resolve to a missing sound
+    sound = Sound.query.get_or_404(id)
+    users = ([f"announcement '{item.announcement.name}'" for item in AnnouncementItem.query.filter_by(sound_id=id)]
+             + [f"saved command '{cmd.name}'" for cmd in SavedCommand.query.filter_by(sound_id=id)])
+    if AnnouncementCommand.query.filter(AnnouncementCommand.sound_id == id, AnnouncementCommand.state != "done").count():
+        users.append("a queued command")
+    if users:
+        flash(f"Sound '{sound.name}' is still used by {', '.join(sorted(set(users)))}.")
+        return redirect(url_for("view_sounds"))
+    db.session.delete(sound)
+    db.session.commit()
+    plan_cache.invalidate()
+    if not Sound.query.filter_by(filename=sound.filename).count():
+        path = os.path.join(UPLOAD_FOLDER, f"{sound.filename}.wav")
+        if os.path.exists(path):
+            os.remove(path)
+    flash("Sound deleted.")
+    return redirect(url_for("view_sounds"))
+
+@app.route("/sounds/analyze")
+def analyze_sound_loudness():
+    if np is None:
+        flash("Loudness analysis needs NumPy.")
+    else:
+        ingest_executor.submit(analyze_sounds)
+        flash("Loudness analysis started.")
+    return redirect(url_for("view_sounds"))
+
+@app.route("/sounds/normalize")
+def normalize_sounds():
+    # Apply the suggested gain to every analyzed sound
+    count = 0
+    for sound in Sound.query.filter(Sound.loudness_db.isnot(None)):
+        sound.loudness_gain = suggested_gain(sound.loudness_db)
+        count += 1
+    db.session.commit()
+    plan_cache.invalidate()
+    flash(f"Normalized {count} sound(s) to {LOUDNESS_TARGET_DB} dB.")
+    return redirect(url_for("view_sounds"))
 
 @app.route("/saved_commands/edit/<int:id>", methods=["GET", "POST"])
 def edit_saved_command(id):
@@ -377,15 +3474,16 @@ def edit_saved_command(id):
         cmd.volume_modifier = int(request.form.get("volume_modifier", 50))
         cmd.times_to_play = int(request.form.get("times_to_play", 1))
         cmd.loop_forever = bool(request.form.get("loop_forever"))
+        cmd.priority = int(request.form.get("priority", DEFAULT_PRIORITY))
         db.session.commit()
         return redirect(url_for("view_saved_commands"))
 
     return render_template("edit_saved_command.html",
                            command=cmd,
-                           intercoms=Intercom.query.all(),
-                           groups=IntercomGroup.query.all(),
-                           announcements=Announcement.query.all(),
-                           sounds=Sound.query.all())
+                           intercoms=catalog.options("intercoms"),
+                           groups=catalog.options("groups"),
+                           announcements=catalog.options("announcements"),
+                           sounds=catalog.options("sounds"))
 
 @app.route("/saved_commands/delete/<int:id>")
 def delete_saved_command(id):
@@ -396,8 +3494,8 @@ def delete_saved_command(id):
 
 @app.route("/saved_commands")
 def view_saved_commands():
-    commands = SavedCommand.query.all()
-    return render_template("saved_commands.html", commands=commands)
+    page = paginate(SavedCommand.query.order_by(SavedCommand.id))
+    return render_template("saved_commands.html", commands=page.items, page=page)
 
 @app.route("/saved_commands/add", methods=["GET", "POST"])
 def add_saved_command():
@@ -410,6 +3508,7 @@ def add_saved_command():
         volume_modifier = int(request.form.get("volume_modifier", 50))
         times_to_play = int(request.form.get("times_to_play", 1))
         loop_forever = bool(request.form.get("loop_forever"))
+        priority = int(request.form.get("priority", DEFAULT_PRIORITY))
 
         cmd = SavedCommand(
             name=name,
@@ -419,102 +3518,139 @@ def add_saved_command():
             sound_id=sound_id,
             volume_modifier=volume_modifier,
             times_to_play=times_to_play,
-            loop_forever=loop_forever
+            loop_forever=loop_forever,
+            priority=priority
         )
         db.session.add(cmd)
         db.session.commit()
         return redirect(url_for("view_saved_commands"))
 
     return render_template("add_saved_command.html",
-                           intercoms=Intercom.query.all(),
-                           groups=IntercomGroup.query.all(),
-                           announcements=Announcement.query.all(),
-                           sounds=Sound.query.all())
+                           intercoms=catalog.options("intercoms"),
+                           groups=catalog.options("groups"),
+                           announcements=catalog.options("announcements"),
+                           sounds=catalog.options("sounds"))
 
-@app.route("/saved_commands/trigger/<int:id>")
-def trigger_saved_command(id):
-    saved = SavedCommand.query.get_or_404(id)
-    new_cmd = AnnouncementCommand(
+def command_from_saved(saved):
+    return AnnouncementCommand(
         intercom_id=saved.intercom_id,
         intercom_group_id=saved.intercom_group_id,
         announcement_id=saved.announcement_id,
         sound_id=saved.sound_id,
         volume_modifier=saved.volume_modifier,
         times_to_play=saved.times_to_play,
-        loop_forever=saved.loop_forever
+        loop_forever=saved.loop_forever,
+        priority=saved.priority
     )
-    db.session.add(new_cmd)
+
+def queue_commands(cmds, triggered_at=None, extra=(), start_at=None):
+    """Write commands (plus any extra rows) in one transaction, then start them.
+
+    start_at (epoch seconds) holds the first step until then, for schedules.
+
+    Highest priority first, so an emergency member is admitted before routine
+    ones. On the dispatcher the rows are inserted already leased, so there's
+    no per-command claim.
+    """
+    cmds = sorted(cmds, key=lambda cmd: -(cmd.priority if cmd.priority is not None else DEFAULT_PRIORITY))
+    claimed = cluster.is_leader
+    for cmd in cmds:
+        cmd.start_at = start_at
+    if claimed:
+        for cmd in cmds:
+            cmd.lease_owner = NODE_ID
+            cmd.lease_expires = time.time() + QUEUE_LEASE_SECONDS
+    db.session.add_all(cmds)
+    db.session.flush()
+    ids = [cmd.id for cmd in cmds]
+    for row in extra:
+        db.session.add(row(ids) if callable(row) else row)
     db.session.commit()
-    command_queue.put(new_cmd.id)  # <--- This was missing
+    # One query reloads the whole batch after the commit expired it
+    AnnouncementCommand.query.filter(AnnouncementCommand.id.in_(ids)).all()
+    command_store.submit_many(cmds, triggered_at=triggered_at, claimed=claimed)
+    return cmds
+
+@app.route("/saved_commands/trigger/<int:id>")
+def trigger_saved_command(id):
+    triggered_at = time.time()
+    saved = SavedCommand.query.get_or_404(id)
+    queue_commands([command_from_saved(saved)], triggered_at=triggered_at)
     return redirect(url_for("view_commands"))
 
 @app.route("/commands/stopall_full")
+@dispatcher_state
 def stop_all_and_clear():
-    intercoms = Intercom.query.all()
-    for intercom in intercoms:
-        try:
-            url = f"http://{intercom.ip_address}:8084/?type=cmd&cmd=stopall"
-            print(f"Sending stop to: {url}")
-            requests.get(url, timeout=1)
-        except Exception as e:
-            print(f"Failed to stop intercom {intercom.name}: {e}")
-
-    # Clear the announcement command table
-    AnnouncementCommand.query.delete()
-    db.session.commit()
-
-    # Clear the in-memory queue
-    while not command_queue.empty():
-        command_queue.get()
-        command_queue.task_done()
-
-    flash("Stop command sent and queue cleared.")
-    return redirect(url_for("view_commands"))
+    requested_at = time.time()
+    # Clears the queue and cancels pending and in-flight playback before the stop goes out
+    report = broadcast_stop(fleet_targets(), clear_queue=True, requested_at=requested_at)
+    return stop_response(report, "Stop command sent and queue cleared.")
 
 @app.route("/sounds/upload", methods=["GET", "POST"])
 def upload_sound():
     if request.method == "POST":
         file = request.files["file"]
         name = request.form["name"].strip()
+        # The body has already been streamed and hashed into an UploadSpool
+        spool = file.stream
+        filename = secure_filename(file.filename or "")
 
-        if file and file.filename.endswith(".wav"):
-            filename = file.filename
-            filepath = os.path.join(app.config["UPLOAD_FOLDER"], file.filename)
-            file.save(filepath)
-            
-            # Calculate duration using wave module
-            duration = get_wav_duration_ms(filepath)
-
-            # Save to database: name (user input), filename (original), duration
-            sound = Sound(name=name, filename=os.path.splitext(filename)[0], play_duration_ms=duration)
+        if file and allowed_file(filename) and not filename.startswith(RENDER_PREFIX):
+            spool.file.flush()
+            try:
+                info = read_wav_info(spool.path)
+            except IngestError as e:
+                spool.discard()
+                flash(f"Invalid file: {e}.")
+                return render_template("upload_sound.html")
+            spool.file.close()
+
+            # Save to database: name (user input), filename (sanitized), duration and format from the header
+            sound = Sound(name=name, filename=os.path.splitext(filename)[0], play_duration_ms=info.duration_ms,
+                          sample_rate=info.sample_rate, channels=info.channels, sample_width=info.sample_width,
+                          file_size=spool.size, sha256=spool.digest.hexdigest(), status="processing")
             db.session.add(sound)
             db.session.commit()
-            flash("Sound uploaded successfully.")
+            if needs_conversion(info) and np is not None:
+                ingest_executor.submit(convert_upload, sound.id, spool.path, info)
+                flash("Sound uploaded; converting to the intercom format.")
+            else:
+                if needs_conversion(info):
+                    print(f"NumPy not installed, keeping {filename} as uploaded")
+                install_sound(sound, spool.path, info, spool.digest.hexdigest())
+                flash("Sound uploaded successfully.")
             return redirect(url_for("view_sounds"))
 
+        if isinstance(spool, UploadSpool):
+            spool.discard()
         flash("Invalid file. Please upload a .wav file.")
     return render_template("upload_sound.html")
 
 
 @app.route("/announcements/edit/<int:id>", methods=["GET", "POST"])
 def edit_announcement(id):
-    ann = Announcement.query.get_or_404(id)
+    ann = Announcement.query.options(selectinload(Announcement.items)).filter_by(id=id).first_or_404()
     if request.method == "POST":
         ann.name = request.form["name"]
         ann.volume_modifier = int(request.form.get("volume_modifier", 0))
-        sound_order_ids = request.form.getlist("sound_order[]")
-        ann.sound_order = ",".join(sound_order_ids)
+        ann.items = []
+        db.session.flush()  # free the positions before the new items take them
+        ann.set_items(request.form.getlist("sound_order[]"), request.form.getlist("item_volume[]"),
+                      request.form.getlist("item_gap[]"))
         db.session.commit()
+        plan_cache.invalidate()
+        render_cache.invalidate_announcement(ann.id)
         return redirect(url_for("view_announcements"))
 
-    sounds = Sound.query.all()
-    return render_template("edit_announcement.html", announcement=ann, sounds=sounds)
+    return render_template("edit_announcement.html", announcement=ann, sounds=catalog.options("sounds"))
 
 @app.route("/announcements/delete/<int:id>")
 def delete_announcement(id):
     ann = Announcement.query.get_or_404(id)
     db.session.delete(ann)
     db.session.commit()
+    plan_cache.invalidate()
+    render_cache.invalidate_announcement(id)
     flash("Announcement deleted.")
     return redirect(url_for("view_announcements"))
 
@@ -526,10 +3662,14 @@ def delete_group(id):
 
     # Delete all related group memberships first
     GroupMembership.query.filter_by(intercom_group_id=group.id).delete()
+    GroupNesting.query.filter(db.or_(GroupNesting.parent_group_id == group.id,
+                                     GroupNesting.child_group_id == group.id)).delete()
 
     # Then delete the group itself
     db.session.delete(group)
     db.session.commit()
+    membership_index.drop_group(id)
+    plan_cache.invalidate()
     flash("Group deleted successfully.")
     return redirect(url_for("view_groups"))
 
@@ -543,93 +3683,68 @@ def delete_intercom(id):
     # Then delete the intercom itself
     db.session.delete(intercom)
     db.session.commit()
+    membership_index.drop_intercom(id)
+    plan_cache.invalidate()
+    sound_sync.forget(id)
     flash("Intercom deleted successfully.")
     return redirect(url_for("view_intercoms"))
 
 
 @app.route("/sounds/sync")
+@dispatcher_state
 def sync_sounds():
+    targets = fleet_targets()
+    job = sound_sync.start_job(targets)
+    flash(f"Sound sync started to {len(targets)} intercom(s) (job {job.id}).")
+    return redirect(url_for("view_sounds"))
 
-    intercoms = Intercom.query.all()
-    for intercom in intercoms:
-        try:
-            ip = intercom.ip_address
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(ip, username=INTERCOM_USERNAME, password=INTERCOM_PASSWORD, timeout=5)
-
-            sftp = ssh.open_sftp()
-
-            # Try to list existing remote files
-            try:
-                remote_files = {
-                    attr.filename: attr.st_size
-                    for attr in sftp.listdir_attr("/var/sounds")
-                }
-            except IOError:
-                # If listing fails (e.g., folder doesn't exist), treat as empty
-                remote_files = {}
-
-            uploaded_count = 0
-            for file in os.listdir(UPLOAD_FOLDER):
-                if not file.endswith(".wav"):
-                    continue
-
-                local_path = os.path.join(UPLOAD_FOLDER, file)
-                remote_path = f"/var/sounds/{file}"
-
-                local_size = os.path.getsize(local_path)
-                remote_size = remote_files.get(file)
-
-                if remote_size == local_size:
-                    continue  # File is already present with same size
-
-                sftp.put(local_path, remote_path)
-                uploaded_count += 1
-
-            sftp.close()
-            ssh.close()
-            print(f"Synced to {intercom.name}: {uploaded_count} file(s) uploaded")
-
-        except Exception as e:
-            print(f"Sync failed for {intercom.name}: {e}")
+@app.route("/sounds/sync/status")
+@app.route("/sounds/sync/status/<int:job_id>")
+@dispatcher_state
+def sync_status(job_id=None):
+    job = sound_sync.job(job_id)
+    if job is None:
+        return jsonify({"error": "no such sync job", "pending": sound_sync.pending()}), 404
+    return jsonify(dict(job.to_dict(), pending=sound_sync.pending()))
 
-    flash("Sound sync completed to all intercoms.")
-    return redirect(url_for("view_sounds"))
 
+@app.template_filter("timestamp")
+def format_timestamp(value):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(value)) if value else "Never"
 
 @app.route("/intercoms/status")
+@dispatcher_state
 def intercom_status():
-    intercoms = Intercom.query.all()
+    # Served from the health monitor's cache; ?refresh=1 asks for a new probe round
+    if request.args.get("refresh"):
+        health_monitor.refresh()
+    cached = {entry["intercom_id"]: entry for entry in health_monitor.snapshot()}
     statuses = []
-
-    for intercom in intercoms:
-        ip = intercom.ip_address
-        url = f"http://{ip}:8084/status"
-        try:
-            response = requests.get(url, timeout=1)
-            result = response.text if response.ok else None
-            statuses.append({
-                "name": intercom.name,
-                "ip": ip,
-                "online": True,
-                "response": result
-            })
-        except Exception:
-            statuses.append({
-                "name": intercom.name,
-                "ip": ip,
-                "online": False,
-                "response": None
-            })
+    for intercom in read_session.query(Intercom):
+        entry = cached.get(intercom.id, {})
+        statuses.append({
+            "intercom_id": intercom.id,
+            "name": intercom.name,
+            "ip": intercom.ip_address,
+            "online": entry.get("online"),
+            "response": entry.get("response"),
+            "latency_ms": entry.get("latency_ms"),
+            "last_seen": entry.get("last_seen"),
+            "last_checked": entry.get("last_checked"),
+        })
 
     return render_template("intercom_status.html", statuses=statuses)
 
+@app.route("/api/intercoms/status")
+@dispatcher_state
+def intercom_status_api():
+    return jsonify(health_monitor.snapshot())
+
 
 @app.route("/saved_command_sets")
 def view_command_sets():
-    sets = SavedCommandSet.query.all()
-    return render_template("saved_command_sets.html", sets=sets)
+    page = paginate(SavedCommandSet.query.options(selectinload(SavedCommandSet.commands)).order_by(SavedCommandSet.id))
+    return render_template("saved_command_sets.html", sets=page.items, page=page)
 
 
 @app.route("/saved_command_sets/add", methods=["GET", "POST"])
@@ -648,8 +3763,7 @@ def add_command_set():
 
         return redirect(url_for("view_command_sets"))
 
-    commands = SavedCommand.query.all()
-    return render_template("add_command_set.html", commands=commands)
+    return render_template("add_command_set.html", commands=catalog.options("saved_commands"))
 
 
 @app.route("/saved_command_sets/edit/<int:id>", methods=["GET", "POST"])
@@ -668,9 +3782,10 @@ def edit_command_set(id):
 
         return redirect(url_for("view_command_sets"))
 
-    commands = SavedCommand.query.all()
-    selected_ids = {cmd.id for cmd in set_obj.commands}  # <- key fix here
-    return render_template("edit_command_set.html", set=set_obj, commands=commands, selected_ids=selected_ids)
+    selected_ids = {cmd_id for (cmd_id,) in db.session.query(SavedCommandSetMembership.saved_command_id)
+                    .filter_by(set_id=id)}
+    return render_template("edit_command_set.html", set=set_obj, commands=catalog.options("saved_commands"),
+                           selected_ids=selected_ids)
 
 @app.route("/saved_command_sets/delete/<int:id>")
 def delete_command_set(id):
@@ -681,49 +3796,276 @@ def delete_command_set(id):
 
 @app.route("/saved_command_sets/trigger/<int:id>")
 def trigger_command_set(id):
+    triggered_at = time.time()
     set_obj = SavedCommandSet.query.get_or_404(id)
-    for cmd in set_obj.commands:  # `cmd` is already a SavedCommand instance
-        new_cmd = AnnouncementCommand(
-            intercom_id=cmd.intercom_id,
-            intercom_group_id=cmd.intercom_group_id,
-            announcement_id=cmd.announcement_id,
-            sound_id=cmd.sound_id,
-            volume_modifier=cmd.volume_modifier,
-            times_to_play=cmd.times_to_play,
-            loop_forever=cmd.loop_forever
-        )
-        db.session.add(new_cmd)
-        db.session.commit()
-        command_queue.put(new_cmd.id)
+    queue_commands([command_from_saved(cmd) for cmd in set_obj.commands], triggered_at=triggered_at)
 
     flash("Command set triggered.")
     return redirect(url_for("view_commands"))
 
+
+@app.route("/schedules")
+def view_schedules():
+    page = paginate(Schedule.query.order_by(Schedule.id))
+    now = time.time()
+    next_fire = {}
+    for schedule in page.items:
+        try:
+            next_fire[schedule.id] = CronRule(schedule.cron).next_after(max(now, schedule.last_fired_at or 0))
+        except ValueError:
+            next_fire[schedule.id] = None
+    return render_template("schedules.html", schedules=page.items, page=page, next_fire=next_fire,
+                           saved_commands=catalog.names("saved_commands"), command_sets=catalog.names("command_sets"))
+
+def save_schedule(schedule):
+    # Fill a Schedule from the form; returns an error message instead if it doesn't parse
+    cron = request.form["cron"].strip()
+    try:
+        CronRule(cron)
+    except ValueError as e:
+        return f"Invalid schedule rule: {e}"
+    saved_command_id = request.form.get("saved_command_id") or None
+    command_set_id = request.form.get("command_set_id") or None
+    if bool(saved_command_id) == bool(command_set_id):
+        return "Pick either a saved command or a command set."
+    schedule.name = request.form["name"]
+    schedule.cron = cron
+    schedule.saved_command_id = saved_command_id
+    schedule.command_set_id = command_set_id
+    schedule.enabled = "enabled" in request.form
+    return None
+
+@app.route("/schedules/add", methods=["GET", "POST"])
+def add_schedule():
+    schedule = Schedule(enabled=True)
+    if request.method == "POST":
+        error = save_schedule(schedule)
+        if not error:
+            schedule.last_fired_at = time.time()  # don't fire for times before it existed
+            db.session.add(schedule)
+            db.session.commit()
+            schedule_engine.changed()
+            return redirect(url_for("view_schedules"))
+        flash(error)
+    return render_template("add_schedule.html", schedule=schedule, saved_commands=catalog.options("saved_commands"),
+                           command_sets=catalog.options("command_sets"))
+
+@app.route("/schedules/edit/<int:id>", methods=["GET", "POST"])
+def edit_schedule(id):
+    schedule = Schedule.query.get_or_404(id)
+    if request.method == "POST":
+        error = save_schedule(schedule)
+        if not error:
+            schedule.last_fired_at = max(schedule.last_fired_at or 0, time.time())
+            db.session.commit()
+            schedule_engine.changed()
+            return redirect(url_for("view_schedules"))
+        db.session.rollback()
+        flash(error)
+    return render_template("add_schedule.html", schedule=schedule, saved_commands=catalog.options("saved_commands"),
+                           command_sets=catalog.options("command_sets"))
+
+@app.route("/schedules/delete/<int:id>")
+def delete_schedule(id):
+    schedule = Schedule.query.get_or_404(id)
+    db.session.delete(schedule)
+    db.session.commit()
+    schedule_engine.changed()
+    return redirect(url_for("view_schedules"))
+
+
+# --- Trigger API ---
+def api_error(status, message, **details):
+    return jsonify(dict(details, error=message)), status
+
+def id_list(value):
+    # A JSON list of ids. A bare string or number is refused rather than
+    # iterated ("12" isn't [1, 2]), and so are true/false and fractions.
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValueError(value)
+    ids = []
+    for item in value:
+        if isinstance(item, bool) or not isinstance(item, (int, str)):
+            raise ValueError(item)
+        ids.append(int(item))
+    return ids
+
+def trigger_response(commands, duplicate, status):
+    return jsonify({
+        "commands": commands,
+        "duplicate": duplicate,
+        "status_url": url_for("api_command_status", ids=",".join(str(command["id"]) for command in commands)),
+        "events_url": url_for("event_stream"),
+    }), status
+
+def command_summary(cmd):
+    return {"id": cmd.id, "state": cmd.state, "priority": cmd.priority}
+
+def replay_trigger(previous, fingerprint):
+    # Same key again: hand back what the first request queued
+    if previous.fingerprint != fingerprint:
+        return api_error(422, "Idempotency-Key was already used for a different request")
+    ids = json.loads(previous.command_ids)
+    found = {cmd.id: command_summary(cmd) for cmd in AnnouncementCommand.query.filter(AnnouncementCommand.id.in_(ids))}
+    return trigger_response([found.get(cmd_id, {"id": cmd_id, "state": "removed"}) for cmd_id in ids], True, 200)
+
+@app.route("/api/trigger", methods=["POST"])
+def api_trigger():
+    """Queue saved commands and saved command sets in one call.
+
+    JSON body: {"saved_commands": [ids], "command_sets": [ids]}. With an
+    Idempotency-Key header (or "idempotency_key" field), repeating the
+    request returns the commands the first one queued instead of queueing
+    them again. Responds 202 once the commands are written and enqueued.
+    """
+    triggered_at = time.time()
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return api_error(400, "Expected a JSON object")
+    try:
+        saved_ids = id_list(body.get("saved_commands"))
+        set_ids = id_list(body.get("command_sets"))
+    except ValueError:
+        return api_error(400, "saved_commands and command_sets must be lists of ids")
+    if not saved_ids and not set_ids:
+        return api_error(400, "Nothing to trigger")
+
+    key = request.headers.get("Idempotency-Key") or body.get("idempotency_key")
+    if key is not None and not isinstance(key, str):
+        return api_error(400, "idempotency_key must be a string")
+    fingerprint = hashlib.sha256(json.dumps([saved_ids, set_ids]).encode()).hexdigest()
+    if key:
+        previous = TriggerRequest.query.get(key)
+        if previous:
+            return replay_trigger(previous, fingerprint)
+
+    saved = {cmd.id: cmd for cmd in SavedCommand.query.filter(SavedCommand.id.in_(saved_ids))} if saved_ids else {}
+    sets = ({s.id: s for s in SavedCommandSet.query.options(selectinload(SavedCommandSet.commands))
+             .filter(SavedCommandSet.id.in_(set_ids))} if set_ids else {})
+    missing_saved = [id for id in saved_ids if id not in saved]
+    missing_sets = [id for id in set_ids if id not in sets]
+    if missing_saved or missing_sets:
+        return api_error(404, "Unknown ids", saved_commands=missing_saved, command_sets=missing_sets)
+
+    members = [saved[id] for id in saved_ids] + [cmd for id in set_ids for cmd in sets[id].commands]
+    extra = []
+    if key:
+        extra.append(lambda ids: TriggerRequest(key=key, fingerprint=fingerprint, command_ids=json.dumps(ids),
+                                                created_at=triggered_at))
+    try:
+        cmds = queue_commands([command_from_saved(cmd) for cmd in members], triggered_at=triggered_at, extra=extra)
+    except exc.IntegrityError:
+        # A concurrent request with the same key got there first
+        db.session.rollback()
+        return replay_trigger(TriggerRequest.query.get(key), fingerprint)
+    return trigger_response([command_summary(cmd) for cmd in cmds], False, 202)
+
+@app.route("/api/commands")
+def api_command_status():
+    """State and progress of queued commands, ?ids=1,2,3 (or all that aren't done)."""
+    query = read_session.query(AnnouncementCommand)
+    ids = [int(id) for id in request.args.get("ids", "").split(",") if id.strip().isdigit()]
+    if ids:
+        query = query.filter(AnnouncementCommand.id.in_(ids))
+    else:
+        query = query.filter(AnnouncementCommand.state != "done")
+    found = {cmd.id: {
+        "id": cmd.id,
+        "state": cmd.state,
+        "priority": cmd.priority,
+        "repetition": cmd.repetition,
+        "step_index": cmd.step_index,
+        "queued_at": cmd.queued_at,
+        "finished_at": cmd.finished_at,
+    } for cmd in query.order_by(AnnouncementCommand.id)}
+    # Ids that are gone were cleared (Stop All & Clear Queue) or deleted
+    return jsonify([found.get(id, {"id": id, "state": "removed"}) for id in ids] if ids else list(found.values()))
+
 @app.route("/")
 def home():
     return render_template("home.html")
 
 
-# --- Init ---
-if __name__ == "__main__":
+# --- Serving ---
+def init_db():
     with app.app_context():
-        db.create_all()
-        AnnouncementCommand.query.delete()
-        db.session.commit()
-        while not command_queue.empty():
-            command_queue.get()
-            command_queue.task_done()
+        # Several WSGI workers may start at once; whoever loses a CREATE race just checks again
+        for attempt in range(3):
+            try:
+                db.create_all()
+                upgrade_schema()
+                break
+            except exc.OperationalError:
+                db.session.rollback()
+                time.sleep(0.5)
+        migrate_sound_order()
+        clean_incoming()
+
+def start_dispatcher():
+    render_cache.load()
+    dispatch_notifier.listen()
+    scheduler.start()
+    command_store.start()
+    sound_sync.start()
+    schedule_engine.start()
+    health_monitor.start()
+
+def create_app(dispatcher=False):
+    """WSGI entry point, e.g. gunicorn -k gthread --threads 16 -w 4 -b 0.0.0.0:8000 "server:create_app()".
+
+    Prepares the database and returns the app. Web workers don't drive the
+    intercoms or probe them; run `python server.py dispatcher` next to them
+    (or pass dispatcher=True for a single-process setup).
+    """
+    init_db()
+    if dispatcher:
+        start_dispatcher()
+    return app
+
+def drain(timeout=DRAIN_TIMEOUT):
+    """Stop dispatching without losing anything: in-flight steps finish, progress
+    is saved and the commands are handed to whichever dispatcher takes over."""
+    print("Draining...")
+    stop_event.set()
+    command_store.wake.set()
+    if command_store.thread:
+        command_store.thread.join(timeout)
+    if not scheduler.wait_idle(timeout):
+        print("Gave up waiting for in-flight steps")
+    scheduler.join(timeout)
+    scheduler.cancel_all(notify=False)
+    with app.app_context():
+        command_store.flush()
+        command_store.release()
+        if cluster.is_leader:
+            cluster.resign()
+    print("Drained")
+
+def run_dispatcher():
+    create_app(dispatcher=True)
+    shutdown = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: shutdown.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown.set())
+    print(f"{NODE_ID} dispatcher running (notify address {dispatch_notifier.address})")
+    while not shutdown.wait(1):
+        pass
+    drain()
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["dispatcher"]:
+        run_dispatcher()
+        sys.exit(0)
 
-    queue_thread = threading.Thread(target=process_queue)
-    queue_thread.start()
+    # Development: UI and dispatcher in one process
+    create_app(dispatcher=True)
 
     def shutdown_handler(signum, frame):
-        print("Shutting down...")
-        stop_event.set()
-        queue_thread.join()
-        os._exit(0)
+        drain()
+        sys.exit(0)
 
     signal.signal(signal.SIGINT, shutdown_handler)
     signal.signal(signal.SIGTERM, shutdown_handler)
 
-    app.run(port=8000, host="0.0.0.0")
+    app.run(port=HTTP_PORT, host="0.0.0.0")